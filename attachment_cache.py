@@ -0,0 +1,225 @@
+import hashlib
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+from constants import ATTACHMENT_CACHE_CHUNK_SIZE
+
+
+class AttachmentCache(object):
+    def __init__(self, directory, max_size):
+        self.directory = directory
+        self.blobs_directory = os.path.join(directory, "blobs")
+        self.max_size = max_size
+        self.lock = threading.Lock()
+
+        os.makedirs(self.blobs_directory, exist_ok=True)
+
+        self.connection = sqlite3.connect(
+            os.path.join(directory, "index.sqlite"),
+            check_same_thread=False,
+        )
+
+        with self.connection:
+            self.connection.execute(
+                """
+                CREATE TABLE IF NOT EXISTS entries (
+                    type TEXT NOT NULL,
+                    idoklad_id INTEGER NOT NULL,
+                    filename TEXT NOT NULL,
+                    sha256 TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    last_used REAL NOT NULL,
+                    PRIMARY KEY (type, idoklad_id, filename)
+                )
+                """
+            )
+
+    def read(self, type, idoklad_id, filename):
+        path = self.get_path(type, idoklad_id, filename)
+
+        if not path:
+            return None
+
+        try:
+            with open(path, "rb") as file:
+                return file.read()
+        except FileNotFoundError:
+            # Evicted by another thread in the meantime
+            return None
+
+    def iter_chunks(self, type, idoklad_id, filename, chunk_size=ATTACHMENT_CACHE_CHUNK_SIZE):
+        path = self.get_path(type, idoklad_id, filename)
+
+        if not path:
+            return None
+
+        try:
+            file = open(path, "rb")
+        except FileNotFoundError:
+            return None
+
+        return iter_open_file(file, chunk_size)
+
+    def get_path(self, type, idoklad_id, filename):
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT sha256 FROM entries WHERE type = ? AND idoklad_id = ? AND filename = ?",
+                (type, idoklad_id, filename),
+            ).fetchone()
+
+        if not row:
+            return None
+
+        path = self.blob_path(row[0])
+
+        if not os.path.exists(path) or not file_sha256(path) == row[0]:
+            print("WARNING: Cached {} of {} {} is corrupted, downloading it again".format(
+                filename,
+                type,
+                idoklad_id,
+            ))
+
+            self.remove(type, idoklad_id, filename)
+
+            return None
+
+        with self.lock, self.connection:
+            self.connection.execute(
+                "UPDATE entries SET last_used = ? WHERE type = ? AND idoklad_id = ? AND filename = ?",
+                (time.time(), type, idoklad_id, filename),
+            )
+
+        return path
+
+    def write(self, type, idoklad_id, filename, content):
+        writer = self.writer(type, idoklad_id, filename)
+        writer.write(content)
+        writer.commit()
+
+    def writer(self, type, idoklad_id, filename):
+        return AttachmentCacheWriter(self, type, idoklad_id, filename)
+
+    def add(self, type, idoklad_id, filename, partial_path, sha256, size):
+        with self.lock, self.connection:
+            # Blobs are content addressed, the same content is stored only once
+            os.replace(partial_path, self.blob_path(sha256))
+
+            self.connection.execute(
+                """
+                INSERT OR REPLACE INTO entries (type, idoklad_id, filename, sha256, size, last_used)
+                VALUES (?, ?, ?, ?, ?, ?)
+                """,
+                (type, idoklad_id, filename, sha256, size, time.time()),
+            )
+
+        self.evict()
+
+    def remove(self, type, idoklad_id, filename):
+        with self.lock, self.connection:
+            self.connection.execute(
+                "DELETE FROM entries WHERE type = ? AND idoklad_id = ? AND filename = ?",
+                (type, idoklad_id, filename),
+            )
+
+        self.remove_unreferenced_blobs()
+
+    def evict(self):
+        with self.lock, self.connection:
+            total_size = self.connection.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM (SELECT DISTINCT sha256, size FROM entries)",
+            ).fetchone()[0]
+
+            if total_size <= self.max_size:
+                return
+
+            rows = self.connection.execute(
+                "SELECT type, idoklad_id, filename, size FROM entries ORDER BY last_used",
+            ).fetchall()
+
+            for row in rows:
+                if total_size <= self.max_size:
+                    break
+
+                self.connection.execute(
+                    "DELETE FROM entries WHERE type = ? AND idoklad_id = ? AND filename = ?",
+                    row[:3],
+                )
+                total_size -= row[3]
+
+        self.remove_unreferenced_blobs()
+
+    def remove_unreferenced_blobs(self):
+        with self.lock:
+            referenced = set(
+                row[0] for row in self.connection.execute("SELECT DISTINCT sha256 FROM entries")
+            )
+
+            for sha256 in os.listdir(self.blobs_directory):
+                if not sha256 in referenced and not sha256.endswith(".part"):
+                    os.remove(self.blob_path(sha256))
+
+    def blob_path(self, sha256):
+        return os.path.join(self.blobs_directory, sha256)
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+class AttachmentCacheWriter(object):
+    def __init__(self, cache, type, idoklad_id, filename):
+        self.cache = cache
+        self.type = type
+        self.idoklad_id = idoklad_id
+        self.filename = filename
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+
+        file_descriptor, self.partial_path = tempfile.mkstemp(
+            dir=cache.blobs_directory,
+            suffix=".part",
+        )
+        self.file = os.fdopen(file_descriptor, "wb")
+
+    def write(self, chunk):
+        self.sha256.update(chunk)
+        self.size += len(chunk)
+        self.file.write(chunk)
+
+    def commit(self):
+        self.file.close()
+        self.cache.add(
+            self.type,
+            self.idoklad_id,
+            self.filename,
+            self.partial_path,
+            self.sha256.hexdigest(),
+            self.size,
+        )
+
+    def discard(self):
+        self.file.close()
+
+        if os.path.exists(self.partial_path):
+            os.remove(self.partial_path)
+
+
+def iter_open_file(file, chunk_size):
+    with file:
+        yield from iter(lambda: file.read(chunk_size), b"")
+
+
+def iter_file(path, chunk_size):
+    return iter_open_file(open(path, "rb"), chunk_size)
+
+
+def file_sha256(path):
+    sha256 = hashlib.sha256()
+
+    for chunk in iter_file(path, ATTACHMENT_CACHE_CHUNK_SIZE):
+        sha256.update(chunk)
+
+    return sha256.hexdigest()
@@ -0,0 +1,85 @@
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+class PrefetchBudget(object):
+    # Attachments handed out stay held until the consumer releases them, after their record is processed
+    def __init__(self, memory_budget):
+        self.memory_budget = memory_budget
+        self.held = 0
+        self.condition = threading.Condition()
+
+    def hold(self, size):
+        with self.condition:
+            self.held += size
+
+    def release(self, size):
+        with self.condition:
+            self.held -= size
+            self.condition.notify_all()
+
+    def wait(self):
+        with self.condition:
+            while self.held >= self.memory_budget:
+                self.condition.wait()
+
+
+def prefetch_attachments(
+    idoklad,
+    idoklad_records,
+    type,
+    depth,
+    budget,
+    should_prefetch,
+):
+    # No new download starts while the downloaded, unprocessed attachments exceed the budget
+    idoklad_records = iter(idoklad_records)
+    queue = deque()
+    exhausted = False
+
+    def buffered_bytes():
+        return budget.held + sum(
+            len(future.result() or "")
+            for _, future in queue
+            if future and future.done() and not future.exception()
+        )
+
+    with ThreadPoolExecutor(max_workers=depth) as executor:
+        while True:
+            while not exhausted and len(queue) < depth + 1:
+                if queue and buffered_bytes() >= budget.memory_budget:
+                    break
+
+                if not queue:
+                    # Nothing to hand out, wait for the records being processed
+                    budget.wait()
+
+                idoklad_record = next(idoklad_records, None)
+
+                if idoklad_record is None:
+                    exhausted = True
+
+                    break
+
+                future = None
+
+                if not idoklad_record.attachment_file_name == "" and should_prefetch(idoklad_record):
+                    future = executor.submit(
+                        idoklad.get_attachment,
+                        type,
+                        idoklad_record.id,
+                        idoklad_record.attachment_file_name,
+                    )
+
+                queue.append((idoklad_record, future))
+
+            if not queue:
+                return
+
+            idoklad_record, future = queue.popleft()
+            attachment = future.result() if future else None
+
+            budget.hold(len(attachment or ""))
+
+            yield idoklad_record, attachment
@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+#
+# Transfer many iDoklad and Fakturoid account pairs, each in its own process and directory
+#
+# Needs Python 3.11 or newer, for ProcessPoolExecutor(max_tasks_per_child=...)
+#
+# The config file is JSON:
+#
+# {
+#     "args": ["--workers", "4"],
+#     "tenants": [
+#         {
+#             "name": "company",
+#             "fakturoid_account": "slug",
+#             "fakturoid_email": "user@example.com",
+#             "fakturoid_api_key": "...",
+#             "idoklad_client_id": "...",
+#             "idoklad_client_secret": "...",
+#             "args": ["--idoklad-incremental"]
+#         }
+#     ]
+# }
+#
+# "args" are main.py arguments, the top-level ones are used for every tenant.
+
+import argparse
+import json
+import os
+import sys
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import redirect_stdout, redirect_stderr
+
+from constants import BATCH_DIRECTORY, BATCH_LOG_FILE, BATCH_TENANT_KEYS, ERROR_MESSAGES
+from main import main as transfer
+
+
+def parseargs(argv):
+    parser = argparse.ArgumentParser(
+        description="Transfer many iDoklad accounts to Fakturoid accounts",
+        add_help=True)
+
+    parser.add_argument("config",
+                        type=str,
+                        help="JSON file with the account pairs.")
+    parser.add_argument("--concurrency",
+                        type=int,
+                        metavar="N",
+                        default=2,
+                        help="Optional. Number of tenants transferred at the same time (default 2).")
+    parser.add_argument("--directory",
+                        type=str,
+                        default=BATCH_DIRECTORY,
+                        help="Optional. Directory with the cache, journal and log of each tenant (default tenants).")
+    parser.add_argument("--only",
+                        type=str,
+                        nargs="+",
+                        metavar="NAME",
+                        help="Optional. Transfer only these tenants.")
+    parser.add_argument("--summary-output",
+                        type=str,
+                        metavar="FILE",
+                        dest="summary_output",
+                        help="Optional. Save the summary of each tenant as JSON to this file.")
+
+    return parser.parse_args(argv)
+
+
+def load_tenants(path):
+    with open(path) as file:
+        config = json.load(file)
+
+    tenants = []
+    names = set()
+
+    for index, tenant in enumerate(config.get("tenants", [])):
+        name = tenant.get("name")
+
+        if not name or name in (".", "..") or os.sep in name or name in names:
+            raise Exception(
+                ERROR_MESSAGES["invalid_tenant"].format(index + 1, "the name is missing, not unique or not a directory name")
+            )
+
+        missing = [key for key in BATCH_TENANT_KEYS if not tenant.get(key)]
+
+        if missing:
+            raise Exception(ERROR_MESSAGES["invalid_tenant"].format(name, "missing " + ", ".join(missing)))
+
+        argv = []
+
+        for key, flag in BATCH_TENANT_KEYS.items():
+            argv += [flag, tenant[key]]
+
+        names.add(name)
+        tenants.append({
+            "name": name,
+            "argv": argv + config.get("args", []) + tenant.get("args", []),
+        })
+
+    return tenants
+
+
+def run_tenant(name, argv, directory):
+    # Each tenant runs in a fresh process, so the relative cache, journal and token paths of main.py
+    # resolve into its directory and its rate limits are not shared with other tenants
+    os.makedirs(directory, exist_ok=True)
+    os.chdir(directory)
+
+    # Nobody can answer a prompt, the ask VAT mismatch policy fails the tenant instead of blocking it
+    sys.stdin = open(os.devnull)
+
+    started_at = time.monotonic()
+    result = {"name": name, "error": None}
+
+    with open(BATCH_LOG_FILE, "a") as log, redirect_stdout(log), redirect_stderr(log):
+        print("--- {}".format(time.strftime("%Y-%m-%d %H:%M:%S")))
+
+        try:
+            result.update(transfer(argv))
+        except SystemExit as e:
+            result["error"] = "main.py exited with code {}".format(e.code)
+        except BaseException as e:
+            traceback.print_exc()
+
+            result["error"] = "{}: {}".format(type(e).__name__, e)
+
+    result["seconds"] = round(time.monotonic() - started_at, 3)
+
+    return result
+
+
+def print_summary(results):
+    print("\n--- Summary")
+
+    for result in results:
+        if result["error"]:
+            print(
+                "{name}: FAILED after {seconds} s, {error}".format(
+                    name=result["name"],
+                    seconds=result["seconds"],
+                    error=result["error"].splitlines()[0],
+                )
+            )
+        else:
+            print(
+                "{name}: {created_invoices} invoices and {created_expenses} expenses created, "
+                "{skipped_invoices} invoices and {skipped_expenses} expenses skipped, "
+                "{requests} requests, {retries} retries in {seconds} s".format(**result)
+            )
+
+
+def main(argv):
+    args = parseargs(argv)
+    tenants = load_tenants(args.config)
+
+    if args.only:
+        tenants = [tenant for tenant in tenants if tenant["name"] in args.only]
+
+    results = []
+
+    # One process per tenant, so nothing a tenant leaves behind leaks into the next one
+    with ProcessPoolExecutor(max_workers=args.concurrency, max_tasks_per_child=1) as executor:
+        futures = {
+            executor.submit(
+                run_tenant,
+                tenant["name"],
+                tenant["argv"],
+                os.path.abspath(os.path.join(args.directory, tenant["name"])),
+            ): tenant
+            for tenant in tenants
+        }
+
+        for future in as_completed(futures):
+            try:
+                result = future.result()
+            except Exception as e:
+                # The worker process itself died
+                result = {"name": futures[future]["name"], "error": repr(e), "seconds": None}
+
+            print(
+                "{name}: {status}".format(
+                    name=result["name"],
+                    status="failed, see its log" if result["error"] else "done",
+                )
+            )
+
+            results.append(result)
+
+    results.sort(key=lambda result: result["name"])
+
+    print_summary(results)
+
+    if args.summary_output:
+        with open(args.summary_output, "w") as file:
+            json.dump(results, file, indent=2)
+
+    return 1 if any(result["error"] for result in results) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
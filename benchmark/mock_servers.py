@@ -0,0 +1,336 @@
+import base64
+import gzip
+import hashlib
+import json
+import random
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+
+FAKTUROID_PAGE_SIZE = 20
+
+
+def make_subject(index):
+    return {
+        "CompanyName": "Company {}".format(index),
+        "Street": "Street {}".format(index),
+        "City": "Praha",
+        "PostalCode": "11000",
+        "Country": {"Code": "CZ"},
+        "IdentificationNumber": str(10000000 + index),
+        "VatIdentificationNumber": "CZ{}".format(10000000 + index),
+        "VatIdentificationNumberSk": "",
+        "Firstname": "Jan",
+        "Surname": "Novak",
+        "Email": "company{}@example.com".format(index),
+        "Mobile": "",
+        "Www": "",
+    }
+
+
+def make_lines(count):
+    return [
+        {
+            "Name": "Item {}".format(line),
+            "Amount": 1,
+            "Unit": "ks",
+            "UnitPrice": 100 + line,
+            "VatRate": 21,
+            "Code": "",
+            "TotalPrice": 121 + line,
+        }
+        for line in range(count)
+    ]
+
+
+def make_record(type, index, subjects, options):
+    rng = random.Random(index if type == "invoice" else -index - 1)
+    subject = subjects[rng.randrange(len(subjects))]
+    paid = rng.random() < options["paid_ratio"]
+    has_attachment = rng.random() < options["attachment_ratio"]
+    record = {
+        "Id": index + 1,
+        "DocumentNumber": "{}{:06d}".format("2020" if type == "invoice" else "DF", index + 1),
+        "VariableSymbol": str(index + 1),
+        "DateLastChange": "2020-01-01T00:00:{:02d}".format(index % 60),
+        "DateOfPayment": "2020-01-20" if paid else "",
+        "AttachmentFileName": "scan.pdf" if has_attachment else "",
+        "Note": "",
+        "Currency": {"Code": "CZK"},
+        "ExchangeRate": 1,
+        "PaymentOption": {"Code": "B"},
+        "MyCompanyDocumentAddress": {
+            "AccountNumber": "123456789",
+            "BankNumberCode": "0100",
+            "Iban": "CZ6501000000000123456789",
+            "Swift": "KOMBCZPP",
+            "VatIdentificationNumber": "CZ12345678",
+        },
+        # Not used by the transfer, only sent when no fields are selected
+        "ConstantSymbolId": 7,
+        "IsEet": False,
+        "Prices": {"TotalWithVat": 0, "TotalWithoutVat": 0, "TotalVat": 0, "TotalPaid": 0},
+        "Tags": [],
+        "Links": [{"Rel": "self", "Href": "/{}/{}".format(type, index + 1)}],
+    }
+
+    if type == "invoice":
+        record.update({
+            "OrderNumber": "",
+            "DateOfIssue": "2020-01-01",
+            "DateOfTaxing": "2020-01-01",
+            "Maturity": "2020-01-15",
+            "ItemsTextPrefix": "",
+            "ItemsTextSuffix": "",
+            "LanguageCode": "cs-CZ",
+            "IssuedInvoiceItems": make_lines(options["lines"]),
+            "Purchaser": subject,
+        })
+    else:
+        record.update({
+            "ReceivedDocumentNumber": "R{}".format(index + 1),
+            "DateOfReceiving": "2020-01-01",
+            "Description": "Expense {}".format(index + 1),
+            "Items": make_lines(options["lines"]),
+            "Supplier": subject,
+        })
+
+    return record
+
+
+class MockState(object):
+    def __init__(self, records, options):
+        self.options = options
+        self.lock = threading.Lock()
+        self.calls = Counter()
+        self.bytes_out = 0
+
+        subjects = [make_subject(index) for index in range(max(1, records // 10))]
+
+        self.idoklad = {
+            "IssuedInvoices": [make_record("invoice", index, subjects, options) for index in range(records)],
+            "ReceivedInvoices": [make_record("expense", index, subjects, options) for index in range(records)],
+        }
+        self.fakturoid = {
+            "invoices": [],
+            "expenses": [],
+            "subjects": [],
+            "bank_accounts": [{"id": 1, "number": "123456789/0100"}],
+        }
+        self.account = {"name": "Benchmark", "vat_no": "CZ12345678"}
+        self.next_id = 1
+        self.tokens = {}
+
+        pdf = b"%PDF-1.4\n" + random.Random(0).randbytes(options["pdf_size"])
+        attachment = random.Random(1).randbytes(options["attachment_size"])
+
+        self.pdf_body = json.dumps(base64.b64encode(pdf).decode("ascii")).encode("utf-8")
+        self.attachment_body = json.dumps(base64.b64encode(attachment).decode("ascii")).encode("utf-8")
+
+    def count(self, method, path):
+        template = re.sub(r"/\d+(?=/|$)", "/{id}", path)
+
+        with self.lock:
+            self.calls["{} {}".format(method, template)] += 1
+
+    def create(self, collection, payload):
+        with self.lock:
+            record = dict(payload)
+            record.pop("attachment", None)
+            record["id"] = self.next_id
+            self.next_id += 1
+            # Fakturoid lists are newest first
+            self.fakturoid[collection].insert(0, record)
+
+            return record
+
+    def issue_token(self):
+        with self.lock:
+            token = "benchmark-{}".format(len(self.tokens) + 1)
+            self.tokens[token] = time.monotonic() + self.options["token_lifetime"]
+
+            return token
+
+    def token_valid(self, authorization):
+        with self.lock:
+            expires_at = self.tokens.get((authorization or "").replace("Bearer ", "", 1))
+
+        return expires_at is not None and time.monotonic() < expires_at
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Send headers and body in one segment, otherwise delayed ACKs dominate the timings
+    wbufsize = 64 * 1024
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.handle_request("GET")
+
+    def do_POST(self):
+        self.handle_request("POST")
+
+    def handle_request(self, method):
+        state = self.server.state
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        body = b""
+
+        if "Content-Length" in self.headers:
+            body = self.rfile.read(int(self.headers["Content-Length"]))
+
+        state.count(method, url.path)
+
+        if state.options["latency"]:
+            time.sleep(state.options["latency"])
+
+        if random.random() < state.options["error_rate"]:
+            return self.send(429, b"{}", {"Retry-After": str(state.options["retry_after"])})
+
+        if url.path == "/token":
+            # Tokens are announced for an hour but expire after --token-lifetime
+            return self.send_json(200, {
+                "access_token": state.issue_token(),
+                "token_type": "Bearer",
+                "expires_in": 3600,
+            })
+
+        if url.path.startswith("/idoklad/"):
+            if not state.token_valid(self.headers.get("Authorization")):
+                return self.send_json(401, {"error": "invalid_token"})
+
+            return self.handle_idoklad(method, url.path[len("/idoklad/"):], query)
+
+        match = re.match(r"^/fakturoid/accounts/[^/]+/(.+)$", url.path)
+
+        if match:
+            return self.handle_fakturoid(method, match.group(1), query, body)
+
+        self.send_json(404, {"error": "not found"})
+
+    def handle_idoklad(self, method, path, query):
+        state = self.server.state
+        match = re.match(r"^(IssuedInvoices|ReceivedInvoices)/Expand$", path)
+
+        if match:
+            records = state.idoklad[match.group(1)]
+            page = int(query.get("page", ["1"])[0])
+            page_size = int(query.get("pagesize", ["50"])[0])
+            total_pages = max(1, (len(records) + page_size - 1) // page_size)
+            data = records[(page - 1) * page_size:page * page_size]
+
+            if "select" in query:
+                fields = query["select"][0].split(",")
+                data = [{field: record[field] for field in fields if field in record} for record in data]
+
+            return self.send_json(200, {
+                "Data": data,
+                "TotalItems": len(records),
+                "TotalPages": total_pages,
+            })
+
+        match = re.match(r"^(IssuedInvoices|ReceivedInvoices)/\d+/(GetPdf|GetAttachment)$", path)
+
+        if match:
+            return self.send(200, state.pdf_body if match.group(2) == "GetPdf" else state.attachment_body)
+
+        self.send_json(404, {"error": "not found"})
+
+    def handle_fakturoid(self, method, path, query, body):
+        state = self.server.state
+
+        if method == "GET" and path == "account.json":
+            return self.send_cached(state.account)
+
+        match = re.match(r"^(invoices|expenses|subjects|bank_accounts)\.json$", path)
+
+        if method == "GET" and match:
+            collection = match.group(1)
+            records = state.fakturoid[collection]
+            page = int(query.get("page", ["1"])[0])
+            total_pages = max(1, (len(records) + FAKTUROID_PAGE_SIZE - 1) // FAKTUROID_PAGE_SIZE)
+            headers = {}
+
+            if total_pages > 1:
+                headers["Link"] = '<http://{host}/fakturoid/{path}?page={page}>; rel="last"'.format(
+                    host=self.headers["Host"],
+                    path=path,
+                    page=total_pages,
+                )
+
+            return self.send_cached(
+                records[(page - 1) * FAKTUROID_PAGE_SIZE:page * FAKTUROID_PAGE_SIZE],
+                headers,
+            )
+
+        if method == "POST" and match:
+            return self.send_json(201, state.create(match.group(1), json.loads(body)))
+
+        if method == "POST" and re.match(r"^(invoices|expenses)/\d+/fire\.json$", path):
+            return self.send_json(200, {})
+
+        self.send_json(404, {"error": "not found"})
+
+    def send_cached(self, data, headers={}):
+        body = json.dumps(data).encode("utf-8")
+        etag = 'W/"{}"'.format(hashlib.md5(body).hexdigest())
+
+        if self.headers.get("If-None-Match") == etag:
+            return self.send(304, b"", dict(headers, ETag=etag))
+
+        self.send(200, body, dict(headers, ETag=etag))
+
+    def send_json(self, status_code, data):
+        self.send(status_code, json.dumps(data).encode("utf-8"))
+
+    def send(self, status_code, body, headers={}):
+        self.send_response(status_code)
+        self.send_header("Content-Type", "application/json")
+
+        for key in headers:
+            self.send_header(key, headers[key])
+
+        # Like the real APIs, larger bodies are compressed when the client accepts it
+        if self.server.state.options["compression"] and len(body) > 1024 and "gzip" in self.headers.get("Accept-Encoding", ""):
+            body = gzip.compress(body, compresslevel=1)
+            self.send_header("Content-Encoding", "gzip")
+
+        if not status_code == 304:
+            self.send_header("Content-Length", str(len(body)))
+
+        self.end_headers()
+
+        if body:
+            self.wfile.write(body)
+
+        with self.server.state.lock:
+            self.server.state.bytes_out += len(body)
+
+
+class MockServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Clients drop their keep-alive connections when main.py exits
+        if isinstance(sys.exc_info()[1], (ConnectionResetError, BrokenPipeError)):
+            return
+
+        super().handle_error(request, client_address)
+
+
+def start_mock_server(records, options, port=0):
+    server = MockServer(("127.0.0.1", port), MockHandler)
+    server.state = MockState(records, options)
+
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    return server
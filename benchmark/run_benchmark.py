@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+#
+# Run main.py against local iDoklad and Fakturoid stand-ins and report its performance
+#
+# Arguments after "--" are passed to main.py, eg. ./run_benchmark.py --records 1000 -- --workers 4
+
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+from mock_servers import start_mock_server
+
+
+ROOT_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def parseargs(argv):
+    parser = argparse.ArgumentParser(
+        description="Benchmark the iDoklad to Fakturoid transfer against local mock servers",
+        add_help=True)
+
+    parser.add_argument("--records",
+                        type=int,
+                        default=1000,
+                        help="Number of iDoklad invoices and of iDoklad expenses (default 1000).")
+    parser.add_argument("--lines",
+                        type=int,
+                        default=3,
+                        help="Number of items of each record (default 3).")
+    parser.add_argument("--latency",
+                        type=float,
+                        default=0.01,
+                        help="Latency of each response in seconds (default 0.01).")
+    parser.add_argument("--error-rate",
+                        type=float,
+                        default=0,
+                        help="Ratio of requests answered with 429 Too Many Requests (default 0).")
+    parser.add_argument("--retry-after",
+                        type=int,
+                        default=1,
+                        help="Retry-After of the injected 429 responses in seconds (default 1).")
+    parser.add_argument("--attachment-ratio",
+                        type=float,
+                        default=0.2,
+                        help="Ratio of records with an attachment (default 0.2).")
+    parser.add_argument("--attachment-size",
+                        type=int,
+                        default=100 * 1024,
+                        help="Attachment size in bytes (default 100 KiB).")
+    parser.add_argument("--pdf-size",
+                        type=int,
+                        default=50 * 1024,
+                        help="PDF size in bytes (default 50 KiB).")
+    parser.add_argument("--paid-ratio",
+                        type=float,
+                        default=0.7,
+                        help="Ratio of paid records (default 0.7).")
+    parser.add_argument("--token-lifetime",
+                        type=float,
+                        default=3600,
+                        help="Seconds after which iDoklad access tokens are rejected, they are always announced for an hour (default 3600).")
+    parser.add_argument("--compression",
+                        default=False,
+                        action="store_true",
+                        help="Compress response bodies with gzip when the client accepts it.")
+    parser.add_argument("--runs",
+                        type=int,
+                        default=1,
+                        help="Number of runs against the same accounts, later runs measure a warm cache (default 1).")
+    parser.add_argument("--output",
+                        type=str,
+                        help="Write the report as JSON to this file.")
+
+    if "--" in argv:
+        separator = argv.index("--")
+
+        return parser.parse_args(argv[:separator]), argv[separator + 1:]
+
+    return parser.parse_args(argv), []
+
+
+def run_main(base_url, work_directory, main_args):
+    command = [
+        sys.executable,
+        os.path.join(ROOT_DIRECTORY, "main.py"),
+        "--fakturoid-account", "benchmark",
+        "--fakturoid-email", "benchmark@example.com",
+        "--fakturoid-api-key", "benchmark",
+        "--idoklad-client-id", "benchmark",
+        "--idoklad-client-secret", "benchmark",
+        "--idoklad-token-url", base_url + "/token",
+        "--idoklad-api-url", base_url + "/idoklad",
+        "--fakturoid-api-url", base_url + "/fakturoid",
+    ] + main_args
+
+    started_at = time.monotonic()
+    process = subprocess.run(
+        command,
+        cwd=work_directory,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        # Answer the VAT number prompt in case a mismatch is configured
+        input=b"yes\n" * 100,
+    )
+    duration = time.monotonic() - started_at
+
+    if not process.returncode == 0:
+        print(process.stdout.decode("utf-8", "replace")[-5000:])
+
+        raise Exception("main.py failed with code {}".format(process.returncode))
+
+    return duration
+
+
+def main(argv):
+    args, main_args = parseargs(argv)
+    options = {
+        "lines": args.lines,
+        "latency": args.latency,
+        "error_rate": args.error_rate,
+        "retry_after": args.retry_after,
+        "attachment_ratio": args.attachment_ratio,
+        "attachment_size": args.attachment_size,
+        "pdf_size": args.pdf_size,
+        "paid_ratio": args.paid_ratio,
+        "token_lifetime": args.token_lifetime,
+        "compression": args.compression,
+    }
+    server = start_mock_server(args.records, options)
+    base_url = "http://127.0.0.1:{}".format(server.server_address[1])
+    reports = []
+
+    print("--- Benchmark: {} invoices and {} expenses, main.py {}".format(
+        args.records,
+        args.records,
+        " ".join(main_args),
+    ))
+
+    with tempfile.TemporaryDirectory() as work_directory:
+        for run in range(1, args.runs + 1):
+            calls_before = sum(server.state.calls.values())
+            bytes_before = server.state.bytes_out
+            created_before = sum(
+                len(server.state.fakturoid[collection]) for collection in ["invoices", "expenses"]
+            )
+
+            duration = run_main(base_url, work_directory, main_args)
+
+            calls = sum(server.state.calls.values()) - calls_before
+            created = sum(
+                len(server.state.fakturoid[collection]) for collection in ["invoices", "expenses"]
+            ) - created_before
+            records = args.records * 2
+            # ru_maxrss is in kilobytes on Linux, the maximum over all finished runs
+            peak_memory = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024
+
+            report = {
+                "run": run,
+                "records": records,
+                "created": created,
+                "seconds": round(duration, 3),
+                "records_per_second": round(records / duration, 2),
+                "api_calls": calls,
+                "api_calls_per_record": round(calls / records, 3),
+                "bytes_sent_by_servers": server.state.bytes_out - bytes_before,
+                "peak_memory_bytes": peak_memory,
+            }
+            reports.append(report)
+
+            print(
+                "Run {run}: {records_per_second} records/s, {api_calls_per_record} API calls per record, "
+                "{created} created in {seconds} s, peak memory {peak_memory:.1f} MiB".format(
+                    peak_memory=peak_memory / 1024 / 1024,
+                    **report
+                )
+            )
+
+    print("\n--- API calls by endpoint")
+
+    for endpoint, count in server.state.calls.most_common():
+        print("{}: {}".format(endpoint, count))
+
+    server.shutdown()
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump({
+                "options": dict(options, records=args.records, main_args=main_args),
+                "runs": reports,
+                "calls": dict(server.state.calls),
+            }, file, indent=2)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
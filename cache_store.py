@@ -0,0 +1,200 @@
+import json
+import os
+import sqlite3
+import threading
+import zlib
+
+import json_codec
+
+
+class CacheStore(object):
+    def __init__(self, path, compress=False):
+        self.compress = compress
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+
+        with self.connection:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute(
+                """
+                CREATE TABLE IF NOT EXISTS pages (
+                    collection TEXT NOT NULL,
+                    page INTEGER NOT NULL,
+                    headers TEXT NOT NULL,
+                    data BLOB,
+                    compressed INTEGER NOT NULL DEFAULT 0,
+                    PRIMARY KEY (collection, page)
+                )
+                """
+            )
+            self.connection.execute(
+                """
+                CREATE TABLE IF NOT EXISTS records (
+                    collection TEXT NOT NULL,
+                    id INTEGER NOT NULL,
+                    data BLOB NOT NULL,
+                    compressed INTEGER NOT NULL DEFAULT 0,
+                    PRIMARY KEY (collection, id)
+                )
+                """
+            )
+            self.connection.execute(
+                """
+                CREATE TABLE IF NOT EXISTS meta (
+                    collection TEXT NOT NULL,
+                    key TEXT NOT NULL,
+                    value TEXT NOT NULL,
+                    PRIMARY KEY (collection, key)
+                )
+                """
+            )
+
+    def collection(self, name):
+        return CacheCollection(self, name)
+
+    def get_headers(self, collection, page):
+        row = self._fetchone(
+            "SELECT headers FROM pages WHERE collection = ? AND page = ?",
+            (collection, page),
+        )
+
+        return json.loads(row[0]) if row else {}
+
+    def get_data(self, collection, page):
+        row = self._fetchone(
+            "SELECT data, compressed FROM pages WHERE collection = ? AND page = ?",
+            (collection, page),
+        )
+
+        if not row or row[0] is None:
+            return None
+
+        return self._decode(row[0], row[1])
+
+    def put(self, collection, page, headers, data, raw=None):
+        # Headers and data of a page are written in one transaction
+        with self.lock, self.connection:
+            self.connection.execute(
+                """
+                INSERT OR REPLACE INTO pages (collection, page, headers, data, compressed)
+                VALUES (?, ?, ?, ?, ?)
+                """,
+                (collection, page, json.dumps(headers), self._encode(data, raw), 1 if self.compress else 0),
+            )
+
+    def get_records(self, collection):
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT data, compressed FROM records WHERE collection = ? ORDER BY id DESC",
+                (collection,),
+            ).fetchall()
+
+        return [self._decode(row[0], row[1]) for row in rows]
+
+    def put_records(self, collection, records):
+        with self.lock, self.connection:
+            self.connection.executemany(
+                """
+                INSERT OR REPLACE INTO records (collection, id, data, compressed)
+                VALUES (?, ?, ?, ?)
+                """,
+                [
+                    (collection, record["id"], self._encode(record), 1 if self.compress else 0)
+                    for record in records
+                ],
+            )
+
+    def delete_records(self, collection):
+        with self.lock, self.connection:
+            self.connection.execute("DELETE FROM records WHERE collection = ?", (collection,))
+
+    def put_headers(self, collection, page, headers):
+        with self.lock, self.connection:
+            updated = self.connection.execute(
+                "UPDATE pages SET headers = ? WHERE collection = ? AND page = ?",
+                (json.dumps(headers), collection, page),
+            )
+
+            if updated.rowcount == 0:
+                self.connection.execute(
+                    "INSERT INTO pages (collection, page, headers) VALUES (?, ?, ?)",
+                    (collection, page, json.dumps(headers)),
+                )
+
+    def get_meta(self, collection, key, default=None):
+        row = self._fetchone(
+            "SELECT value FROM meta WHERE collection = ? AND key = ?",
+            (collection, key),
+        )
+
+        return json.loads(row[0]) if row else default
+
+    def set_meta(self, collection, key, value):
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO meta (collection, key, value) VALUES (?, ?, ?)",
+                (collection, key, json.dumps(value)),
+            )
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+    def _encode(self, data, raw=None):
+        encoded = raw if raw is not None else json_codec.dumps(data)
+
+        if self.compress:
+            encoded = zlib.compress(encoded)
+
+        return encoded
+
+    def _decode(self, data, compressed):
+        return json_codec.loads(zlib.decompress(data) if compressed else data)
+
+    def _fetchone(self, query, parameters):
+        with self.lock:
+            return self.connection.execute(query, parameters).fetchone()
+
+
+class CacheCollection(object):
+    def __init__(self, store, name):
+        self.store = store
+        self.name = name
+
+    def get_headers(self, page):
+        return self.store.get_headers(self.name, page)
+
+    def get_data(self, page):
+        return self.store.get_data(self.name, page)
+
+    def put(self, page, headers, data, raw=None):
+        self.store.put(self.name, page, headers, data, raw)
+
+    def put_headers(self, page, headers):
+        self.store.put_headers(self.name, page, headers)
+
+    def get_records(self):
+        return self.store.get_records(self.name)
+
+    def put_records(self, records):
+        self.store.put_records(self.name, records)
+
+    def delete_records(self):
+        self.store.delete_records(self.name)
+
+    def get_meta(self, key, default=None):
+        return self.store.get_meta(self.name, key, default)
+
+    def set_meta(self, key, value):
+        self.store.set_meta(self.name, key, value)
+
+
+def open_cache_store(path, compress=False):
+    try:
+        return CacheStore(path, compress)
+    except sqlite3.DatabaseError as e:
+        print("WARNING: Cache load failed: {}. Continuing anyway.".format(e))
+
+        os.remove(path)
+
+        return CacheStore(path, compress)
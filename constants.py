@@ -1,7 +1,77 @@
-CACHE_FILE = "transfer_idoklad2fakturoid.cache"
+IDOKLAD_TOKEN_URL = "https://identity.idoklad.cz/server/connect/token"
+IDOKLAD_API_URL = "https://api.idoklad.cz/v2"
+FAKTUROID_API_URL = "https://app.fakturoid.cz/api/v2"
+CACHE_FILE = "transfer_idoklad2fakturoid.cache.sqlite"
+JOURNAL_FILE = "transfer_idoklad2fakturoid.journal"
+IDOKLAD_TOKEN_FILE = "transfer_idoklad2fakturoid.token"
+IDOKLAD_TOKEN_REFRESH_MARGIN = 300
+JOURNAL_STAGE_SUBJECT = "subject"
+JOURNAL_STAGE_CREATED = "created"
+JOURNAL_STAGE_PAID = "paid"
 EXPORT_DIRECTORY = "exports"
 EXPORT_INVOICE_DIRECTORY = "invoices"
 EXPORT_EXPENSE_DIRECTORY = "expenses"
+EXPORT_CHUNK_SIZE = 64 * 1024
+ATTACHMENT_CACHE_DIRECTORY = "transfer_idoklad2fakturoid.attachments"
+ATTACHMENT_CACHE_CHUNK_SIZE = 64 * 1024
+IDOKLAD_PAGE_SIZE = 50
+IDOKLAD_PAGE_SIZE_MIN = 10
+IDOKLAD_PAGE_SIZE_MAX = 200
+IDOKLAD_PAGE_TARGET_BYTES = 1024 * 1024
+IDOKLAD_PAGE_TARGET_SECONDS = 5
+IDOKLAD_PAGE_RETRIES = 3
+IDOKLAD_RECORD_FIELDS = [
+    "Id",
+    "DocumentNumber",
+    "DateLastChange",
+    "DateOfPayment",
+    "AttachmentFileName",
+    "VariableSymbol",
+    "Note",
+    "Currency",
+    "ExchangeRate",
+    "PaymentOption",
+    "MyCompanyDocumentAddress",
+]
+IDOKLAD_INVOICE_FIELDS = IDOKLAD_RECORD_FIELDS + [
+    "OrderNumber",
+    "DateOfIssue",
+    "DateOfTaxing",
+    "Maturity",
+    "ItemsTextPrefix",
+    "ItemsTextSuffix",
+    "LanguageCode",
+    "IssuedInvoiceItems",
+    "Purchaser",
+]
+IDOKLAD_EXPENSE_FIELDS = IDOKLAD_RECORD_FIELDS + [
+    "ReceivedDocumentNumber",
+    "DateOfReceiving",
+    "Description",
+    "Items",
+    "Supplier",
+]
+RATE_LIMIT_PER_SECOND = None
+RATE_LIMIT_MIN_PER_SECOND = 1
+RATE_LIMIT_INCREASE = 1
+RATE_LIMIT_BURST = 10
+RATE_LIMIT_MAX_RETRIES = 5
+RATE_LIMIT_BACKOFF_BASE = 1
+RATE_LIMIT_BACKOFF_MAX = 60
+FAKTUROID_DELTA_OVERLAP = 300
+PREFETCH_MEMORY_BUDGET = 64 * 1024 * 1024
+METRICS_LATENCY_BUCKETS = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30]
+PROFILE_SLOWEST_RECORDS = 10
+BATCH_DIRECTORY = "tenants"
+BATCH_LOG_FILE = "transfer_idoklad2fakturoid.log"
+BATCH_TENANT_KEYS = {
+    "fakturoid_account": "--fakturoid-account",
+    "fakturoid_email": "--fakturoid-email",
+    "fakturoid_api_key": "--fakturoid-api-key",
+    "idoklad_client_id": "--idoklad-client-id",
+    "idoklad_client_secret": "--idoklad-client-secret",
+}
+VAT_MISMATCH_POLICIES = ("ask", "accept", "skip", "abort")
 PAYMENT_METHOD_IDOKLAD_TO_FAKTUROID = {
     "B": "bank",
     "H": "cash",
@@ -14,4 +84,8 @@ ERROR_MESSAGES = {
     "unknown_payment_method": "Unknown iDoklad payment method code: {}, record number: {}",
     "bank_account_not_found": "Unknown iDoklad bank account: {}, record number: {}",
     "unknown_record_type": "Unknown record type: {}",
+    "invalid_tenant": "Invalid tenant {} in the batch config: {}",
+    "invalid_vat_mismatch_policy": "Invalid VAT mismatch policy {!r} in the policy file, {} number: {}",
+    "journal_scope_mismatch": "The journal belongs to other accounts ({}) than this run ({}), run it in another directory or remove the journal",
+    "vat_number_mismatch": "Aborted, {} records have a different VAT number than your Fakturoid account",
 }
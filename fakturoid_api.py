@@ -1,20 +1,42 @@
 import requests
-from urllib.parse import urlparse, parse_qs
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter, DEFAULT_POOLSIZE
+from datetime import datetime, timedelta, timezone
+from urllib.parse import urlparse, parse_qs, quote
 
-from constants import ERROR_MESSAGES
+from constants import ERROR_MESSAGES, FAKTUROID_API_URL, FAKTUROID_DELTA_OVERLAP
+from request_scheduler import RequestScheduler
+import json_codec
 
 
 class FakturoidAPI(object):
-    def __init__(self, account_name, email, api_key):
+    def __init__(
+        self,
+        account_name,
+        email,
+        api_key,
+        concurrency=1,
+        scheduler=None,
+        api_url=FAKTUROID_API_URL,
+        metrics=None,
+    ):
         self.session = requests.Session()
         self.session.auth = (email, api_key)
         self.session.headers.update(
             {
-                "User-Agent": "transfer_idoklad2fakturoid (m.drbohlav1@gmail.com)"
+                "User-Agent": "transfer_idoklad2fakturoid (m.drbohlav1@gmail.com)",
+                "Accept-Encoding": json_codec.ACCEPT_ENCODING,
             }
         )
-
-        self.api_url = "https://app.fakturoid.cz/api/v2/accounts/{slug}".format(
+        adapter = HTTPAdapter(pool_maxsize=max(concurrency, DEFAULT_POOLSIZE))
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.concurrency = concurrency
+        self.scheduler = scheduler if scheduler else RequestScheduler()
+        self.metrics = metrics
+
+        self.api_url = "{api_url}/accounts/{slug}".format(
+            api_url=api_url,
             slug=account_name,
         )
 
@@ -23,130 +45,180 @@ class FakturoidAPI(object):
             "ETag": "If-None-Match",
             "Last-Modified": "If-Modified-Since",
         }
-        headers = {}
-        result = {}
 
         print("--- Fakturoid - loading account")
 
-        if "headers" in cache:
-            headers = cache["headers"]
+        path = "/account.json"
+
+        return self.get_cached(cache, cache_headers, path, 0)[0]
+
+    def get_records(self, cache, cache_headers, type, path):
+        print("--- Fakturoid - loading {}".format(type))
+
+        return self.load_pages(
+            type,
+            lambda page: self.get_records_page(cache, cache_headers, path, page),
+            cache,
+        )
+
+    def get_records_delta(self, cache, type, path):
+        # The merged records are never revalidated, records of another account or API would stay forever
+        if not cache.get_meta("api_url") == self.api_url:
+            cache.delete_records()
+            cache.set_meta("synced_at", None)
+            cache.set_meta("api_url", self.api_url)
+
+        synced_at = cache.get_meta("synced_at")
+        # Overlap the previous sync a bit, records are merged by id so repeats are harmless
+        started_at = datetime.now(timezone.utc) - timedelta(seconds=FAKTUROID_DELTA_OVERLAP)
+
+        if synced_at:
+            print("--- Fakturoid - loading {} updated since {}".format(type, synced_at))
+
+            path = "{path}?updated_since={updated_since}".format(
+                path=path,
+                updated_since=quote(synced_at, safe=""),
+            )
         else:
-            cache["headers"] = {}
+            print("--- Fakturoid - loading {}".format(type))
 
-        path = "/account.json"
-        response = self._api_get(path=path, headers=headers)
+        records = self.load_pages(type, lambda page: self.get_page(path, page))
 
-        for header_key in cache_headers:
-            if header_key in response.headers:
-                cache["headers"][cache_headers[header_key]] = response.headers[header_key]
+        cache.put_records(records)
+        cache.set_meta("synced_at", started_at.isoformat(timespec="seconds"))
 
-        while True:
-            if response.status_code == 200 or response.status_code == 304:
-                if response.status_code == 200:
-                    result = response.json()
-                    cache["data"] = result
+        result = cache.get_records()
 
-                    break
-                elif "data" in cache:
-                    print("Cache hit")
+        print("Merged {changed} changed into {total} {type}".format(
+            changed=len(records),
+            total=len(result),
+            type=type,
+        ))
 
-                    result = cache["data"]
+        return result
 
-                    break
-                else:
-                    print("Cache miss, reload account")
+    def load_pages(self, type, load_page, cache=None):
+        total_pages = 1
+        result = []
 
-                    headers["If-None-Match"] = "W/\"reload\""
-            else:
-                raise Exception(
-                    ERROR_MESSAGES["request_failed"].format(
-                        "GET", path, response.status_code, response.text
-                    ),
+        data, response = load_page(1)
+
+        if "last" in response.links:
+            parsed_url = urlparse(response.links["last"]["url"])
+            total_pages = int(parse_qs(parsed_url.query)['page'][0])
+
+            if cache and not cache.get_meta("total_pages") == total_pages:
+                cache.set_meta("total_pages", total_pages)
+        elif cache:
+            total_pages = cache.get_meta("total_pages", 1)
+
+        result += data
+
+        print(
+            "Loaded page {page} of {total_pages}, so far {so_far} {type}".format(
+                page=1,
+                total_pages=total_pages,
+                so_far=len(result),
+                type=type,
+            )
+        )
+
+        if total_pages > 1:
+            with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+                pages = executor.map(
+                    lambda page: load_page(page)[0],
+                    range(2, total_pages + 1),
                 )
 
+                for page, data in enumerate(pages, start=2):
+                    result += data
+
+                    print(
+                        "Loaded page {page} of {total_pages}, so far {so_far} {type}".format(
+                            page=page,
+                            total_pages=total_pages,
+                            so_far=len(result),
+                            type=type,
+                        )
+                    )
+
         return result
 
+    def get_page(self, path, page):
+        print("Loading page {}".format(page))
 
-    def get_records(self, cache, cache_headers, type, path):
-        headers = {}
-        total_pages = 1
-        page = 1
-        result = []
+        whole_path = "/{path}{separator}page={page}".format(
+            path=path,
+            separator="&" if "?" in path else "?",
+            page=page,
+        )
+        response = self._api_get(path=whole_path)
 
-        if not type in cache:
-            cache[type] = {}
+        if response.status_code == 200:
+            return json_codec.response_json(response), response
+        else:
+            raise Exception(
+                ERROR_MESSAGES["request_failed"].format(
+                    "GET", whole_path, response.status_code, response.text
+                ),
+            )
 
-        print("--- Fakturoid - loading {}".format(type))
+    def get_records_page(self, cache, cache_headers, path, page):
+        print("Loading page {}".format(page))
 
-        while page <= total_pages:
-            print("Loading page {}".format(page))
+        whole_path = "/{path}?page={page}".format(path=path, page=page)
 
-            if page in cache[type]:
-                if "headers" in cache[type][page]:
-                    headers = cache[type][page]["headers"]
-                else:
-                    cache[type][page]["headers"] = {}
-            else:
-                cache[type][page] = {"headers": {}}
+        return self.get_cached(cache, cache_headers, whole_path, page)
 
-            whole_path = "/{path}?page={page}".format(path=path, page=page)
-            response = self._api_get(path=whole_path, headers=headers)
+    def get_cached(self, cache, cache_headers, path, page):
+        cached_headers = cache.get_headers(page)
+        headers = dict(cached_headers)
+
+        while True:
+            response = self._api_get(path=path, headers=headers)
+            response_headers = dict(cached_headers)
 
             for header_key in cache_headers:
                 if header_key in response.headers:
-                    cache[type][page]["headers"][cache_headers[header_key]
-                                                 ] = response.headers[header_key]
-            
-            if total_pages == 1:
-                if "last" in response.links and total_pages == 1:
-                    parsed_url = urlparse(response.links["last"]["url"])
-                    total_pages = int(parse_qs(parsed_url.query)['page'][0])
-                    cache[type]["total_pages"] = total_pages
-                elif "total_pages" in cache[type]:
-                    total_pages = cache[type]["total_pages"]
-
-            if response.status_code == 200 or response.status_code == 304:
-                data = []
-
-                if response.status_code == 200:
-                    data = response.json()
-                    cache[type][page]["data"] = data
-                elif "data" in cache[type][page]:
-                    print("Cache hit for page {}".format(page))
-
-                    data = cache[type][page]["data"]
-                else:
-                    print("Cache miss, reload page {}".format(page))
-
-                    headers["If-None-Match"] = "W/\"reload\""
-
-                    continue
-
-                result += data
-
-                print(
-                    "Loaded page {page} of {total_pages}, so far {so_far} {type}".format(
-                        page=page,
-                        total_pages=total_pages,
-                        so_far=len(result),
-                        type=type,
-                    )
-                )
+                    response_headers[cache_headers[header_key]] = response.headers[header_key]
+
+            if response.status_code == 200:
+                data = json_codec.response_json(response)
+                # The cache keeps the body as received instead of encoding the data again
+                cache.put(page, response_headers, data, response.content)
+
+                return data, response
+            elif response.status_code == 304:
+                data = cache.get_data(page)
+
+                if data is not None:
+                    print("Cache hit for {}".format(path))
+
+                    if not response_headers == cached_headers:
+                        cache.put_headers(page, response_headers)
 
-                page += 1
+                    return data, response
+
+                print("Cache miss, reload {}".format(path))
+
+                headers["If-None-Match"] = "W/\"reload\""
             else:
                 raise Exception(
                     ERROR_MESSAGES["request_failed"].format(
-                        "GET", whole_path, response.status_code, response.text
+                        "GET", path, response.status_code, response.text
                     ),
                 )
 
-        return result
+    def get_invoices(self, cache, delta=False):
+        if delta:
+            return self.get_records_delta(cache, "invoices", "invoices.json")
 
-    def get_invoices(self, cache):
         return self.get_records(cache, {"ETag": "If-None-Match"}, "invoices", "invoices.json")
 
-    def get_expenses(self, cache):
+    def get_expenses(self, cache, delta=False):
+        if delta:
+            return self.get_records_delta(cache, "expenses", "expenses.json")
+
         return self.get_records(cache, {"ETag": "If-None-Match"}, "expenses", "expenses.json")
 
     def get_subjects(self, cache):
@@ -165,7 +237,7 @@ class FakturoidAPI(object):
         response = self._api_post("/" + path, subject)
 
         if response.status_code == 201:
-            return response.json()
+            return json_codec.response_json(response)
         else:
             raise Exception(
                 ERROR_MESSAGES["request_failed"].format(
@@ -177,7 +249,7 @@ class FakturoidAPI(object):
         response = self._api_post("/" + path, item)
 
         if response.status_code == 201:
-            return response.json()
+            return json_codec.response_json(response)
         else:
             raise Exception(
                 ERROR_MESSAGES["request_failed"].format(
@@ -220,7 +292,22 @@ class FakturoidAPI(object):
             )
 
     def _api_get(self, path, headers={}):
-        return self.session.get(self.api_url + path, headers=headers)
+        return self.scheduler.request(
+            self.session,
+            "GET",
+            self.api_url + path,
+            self.metrics,
+            ("fakturoid", path),
+            headers=headers,
+        )
 
     def _api_post(self, path, payload):
-        return self.session.post(self.api_url + path, json=payload)
+        return self.scheduler.request(
+            self.session,
+            "POST",
+            self.api_url + path,
+            self.metrics,
+            ("fakturoid", path),
+            data=json_codec.dumps(payload),
+            headers={"Content-Type": "application/json"},
+        )
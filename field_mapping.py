@@ -0,0 +1,114 @@
+class Argument(object):
+    def __init__(self, name):
+        self.name = name
+
+
+class Constant(object):
+    def __init__(self, value):
+        self.value = value
+
+
+class Computed(object):
+    def __init__(self, function, path=None):
+        self.function = function
+        self.path = path
+
+
+class Optional(object):
+    def __init__(self, source):
+        self.source = source
+
+
+def compile_mapping(spec, arguments=(), skip=None, name="convert"):
+    # The spec is turned into the source of a function building the dict literal directly,
+    # so converting a record costs no more than the hand-written builder it replaces
+    namespace = {"skip": skip}
+    fields = []
+    optional_fields = []
+
+    for argument in arguments:
+        if not argument.isidentifier() or argument in ("record", "result", "value"):
+            raise ValueError("Invalid mapping argument {!r}".format(argument))
+
+    for index, (key, source) in enumerate(spec.items()):
+        if isinstance(source, Optional):
+            optional_fields.append((key, source_expression(source.source, index, arguments, namespace)))
+        else:
+            fields.append((key, source_expression(source, index, arguments, namespace)))
+
+    dict_literal = "{" + ", ".join("{!r}: {}".format(key, expression) for key, expression in fields) + "}"
+    lines = ["def {}(record{}):".format(name, "".join(", " + argument for argument in arguments))]
+
+    if optional_fields:
+        lines.append("    result = " + dict_literal)
+
+        for key, expression in optional_fields:
+            lines += [
+                "    value = " + expression,
+                "    if value:",
+                "        result[{!r}] = value".format(key),
+            ]
+
+        lines.append("    return result")
+    else:
+        lines.append("    return " + dict_literal)
+
+    item = dict_literal if not optional_fields else "{}(record{})".format(
+        name,
+        "".join(", " + argument for argument in arguments),
+    )
+
+    # Arguments of the batch function are sequences parallel to the records
+    lines += [
+        "",
+        "def {}_batch(records{}):".format(name, "".join(", " + argument for argument in arguments)),
+        "    return [{item} for record{names} in {iterable}{condition}]".format(
+            item=item,
+            names="".join(", " + argument for argument in arguments),
+            iterable="zip(records{})".format("".join(", " + argument for argument in arguments)) if arguments else "records",
+            condition=" if not skip(record)" if skip else "",
+        ),
+    ]
+
+    exec(compile("\n".join(lines), "<mapping {}>".format(name), "exec"), namespace)
+
+    convert = namespace[name]
+    convert.batch = namespace[name + "_batch"]
+
+    return convert
+
+
+def source_expression(source, index, arguments, namespace):
+    if isinstance(source, str):
+        return "record" + path_expression(source)
+
+    if isinstance(source, Argument):
+        if not source.name in arguments:
+            raise ValueError("Unknown mapping argument {!r}".format(source.name))
+
+        return source.name
+
+    if isinstance(source, Constant):
+        namespace["constant_{}".format(index)] = source.value
+
+        return "constant_{}".format(index)
+
+    if isinstance(source, Computed):
+        namespace["function_{}".format(index)] = source.function
+
+        return "function_{}(record{})".format(
+            index,
+            path_expression(source.path) if source.path else "",
+        )
+
+    raise ValueError("Invalid mapping source {!r}".format(source))
+
+
+def path_expression(path):
+    parts = path.split(".")
+
+    for part in parts:
+        if not part.isidentifier():
+            raise ValueError("Invalid mapping path {!r}".format(path))
+
+    return "".join("." + part for part in parts)
@@ -1,12 +1,31 @@
 import sys
+import json
 import argparse
-import os
-import base64
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from contextlib import nullcontext
 
-from constants import PAYMENT_METHOD_IDOKLAD_TO_FAKTUROID, ERROR_MESSAGES, EXPORT_DIRECTORY, EXPORT_INVOICE_DIRECTORY, EXPORT_EXPENSE_DIRECTORY
+from constants import PAYMENT_METHOD_IDOKLAD_TO_FAKTUROID, ERROR_MESSAGES, RATE_LIMIT_PER_SECOND, JOURNAL_STAGE_SUBJECT, JOURNAL_STAGE_CREATED, PREFETCH_MEMORY_BUDGET, VAT_MISMATCH_POLICIES, IDOKLAD_TOKEN_URL, IDOKLAD_API_URL, FAKTUROID_API_URL
+from transfer_journal import journal_record_finished
+from attachment_prefetch import prefetch_attachments, PrefetchBudget
+from profiling import NULL_TRACER
+from field_mapping import compile_mapping, Argument, Constant, Computed, Optional
 
 
-def parseargs():
+class KeyedLocks(object):
+    def __init__(self):
+        self.locks = {}
+        self.locks_lock = threading.Lock()
+
+    def lock(self, key):
+        with self.locks_lock:
+            if not key in self.locks:
+                self.locks[key] = threading.Lock()
+
+            return self.locks[key]
+
+
+def parseargs(argv=None):
     parser = argparse.ArgumentParser(
         description="Import invoices, expenses and contacts from iDoklad to Fakturoid",
         add_help=True)
@@ -15,20 +34,17 @@ def parseargs():
                         type=str,
                         metavar="NAME",
                         dest="fakturoid_account_name",
-                        required=True,
-                        help="Your Fatkuroid account slug.")
+                        help="Your Fatkuroid account slug. Required unless --export-only.")
     parser.add_argument("--fakturoid-email",
                         type=str,
                         metavar="EMAIL",
                         dest="fakturoid_email",
-                        required=True,
-                        help="Your Fakturoid e-mail.")
+                        help="Your Fakturoid e-mail. Required unless --export-only.")
     parser.add_argument("--fakturoid-api-key",
                         type=str,
                         metavar="API_KEY",
                         dest="fakturoid_api_key",
-                        required=True,
-                        help="Your Fakturoid API key.")
+                        help="Your Fakturoid API key. Required unless --export-only.")
     parser.add_argument("--idoklad-client-id",
                         type=str,
                         metavar="CLIENT_ID",
@@ -51,35 +67,212 @@ def parseargs():
                         default=False,
                         action="store_true",
                         help="Optional. Disables the VAT number check for your Fakturoid account and each iDoklad invoice and expense.")
+    parser.add_argument("--vat-mismatch-policy",
+                        type=str,
+                        choices=VAT_MISMATCH_POLICIES,
+                        dest="vat_mismatch_policy",
+                        default="skip",
+                        help="Optional. What to do with records whose VAT number does not match your Fakturoid account: ask once for all of them, accept, skip or abort (default skip).")
+    parser.add_argument("--vat-mismatch-policy-file",
+                        type=str,
+                        metavar="FILE",
+                        dest="vat_mismatch_policy_file",
+                        help="Optional. JSON file with the VAT mismatch policy of single records, eg. {\"invoice\": {\"20190001\": \"accept\"}}.")
     parser.add_argument("--export-idoklad-as-pdf",
                         dest="export_idoklad_as_pdf",
                         default=False,
                         action="store_true",
                         help="Optional. Export the iDoklad invoices and expenses as PDF.")
-
-    return parser.parse_args(sys.argv[1:])
-
-
-def make_subject(idoklad_subject, type):
-    return {
-        "type": type,
-        "name": idoklad_subject["CompanyName"],
-        "street": idoklad_subject["Street"],
-        "city":	idoklad_subject["City"],
-        "zip": idoklad_subject["PostalCode"],
-        "country": idoklad_subject["Country"]["Code"],
-        "registration_no": idoklad_subject["IdentificationNumber"],
-        "vat_no": idoklad_subject["VatIdentificationNumber"],
-        "local_vat_no": idoklad_subject["VatIdentificationNumberSk"],
-        "enabled_reminders": False,
-        "full_name": " ".join([
-            idoklad_subject["Firstname"],
-            idoklad_subject["Surname"],
-        ]).strip(),
-        "email": idoklad_subject["Email"],
-        "phone": idoklad_subject["Mobile"],
-        "web": idoklad_subject["Www"],
-    }
+    parser.add_argument("--export-only",
+                        dest="export_only",
+                        default=False,
+                        action="store_true",
+                        help="Optional. Only export the iDoklad invoices and expenses as PDF, do not transfer them.")
+    parser.add_argument("--export-concurrency",
+                        type=int,
+                        metavar="N",
+                        dest="export_concurrency",
+                        default=4,
+                        help="Optional. Number of PDFs exported concurrently (default 4).")
+    parser.add_argument("--attachment-cache-size",
+                        type=int,
+                        metavar="BYTES",
+                        dest="attachment_cache_size",
+                        default=0,
+                        help="Optional. Keep downloaded iDoklad attachments and PDFs in a local cache of this size, least recently used ones are removed first (default 0, disabled).")
+    parser.add_argument("--idoklad-token-url",
+                        type=str,
+                        metavar="URL",
+                        dest="idoklad_token_url",
+                        default=IDOKLAD_TOKEN_URL,
+                        help="Optional. iDoklad OAuth2 token URL, eg. for a local test server.")
+    parser.add_argument("--idoklad-api-url",
+                        type=str,
+                        metavar="URL",
+                        dest="idoklad_api_url",
+                        default=IDOKLAD_API_URL,
+                        help="Optional. iDoklad API URL, eg. for a local test server.")
+    parser.add_argument("--fakturoid-api-url",
+                        type=str,
+                        metavar="URL",
+                        dest="fakturoid_api_url",
+                        default=FAKTUROID_API_URL,
+                        help="Optional. Fakturoid API URL, eg. for a local test server.")
+    parser.add_argument("--metrics-output",
+                        type=str,
+                        metavar="FILE",
+                        dest="metrics_output",
+                        help="Optional. Save latency and status code of each request attempt, time throttled before them, decoded bytes and cache hits of each API endpoint to this file at the end of the run.")
+    parser.add_argument("--metrics-format",
+                        type=str,
+                        dest="metrics_format",
+                        choices=["json", "prometheus"],
+                        default="json",
+                        help="Optional. Format of the --metrics-output file, json or prometheus (default json).")
+    parser.add_argument("--profile",
+                        type=str,
+                        metavar="FILE",
+                        dest="profile",
+                        help="Optional. Time each stage of each record and save a Chrome/Perfetto trace to this file.")
+    parser.add_argument("--profile-cprofile",
+                        type=str,
+                        metavar="DIRECTORY",
+                        dest="profile_cprofile",
+                        help="Optional. Save a cProfile dump of each top-level phase of the run to this directory.")
+    parser.add_argument("--idoklad-concurrency",
+                        type=int,
+                        metavar="N",
+                        dest="idoklad_concurrency",
+                        default=4,
+                        help="Optional. Number of iDoklad pages loaded concurrently (default 4).")
+    parser.add_argument("--idoklad-select-fields",
+                        dest="idoklad_select_fields",
+                        default=False,
+                        action="store_true",
+                        help="Optional. Ask iDoklad only for the invoice and expense fields used by the transfer.")
+    parser.add_argument("--idoklad-adaptive-page-size",
+                        dest="idoklad_adaptive_page_size",
+                        default=False,
+                        action="store_true",
+                        help="Optional. Choose the iDoklad page size from the size and latency of the first page.")
+    parser.add_argument("--reconcile-subjects",
+                        dest="reconcile_subjects",
+                        default=False,
+                        action="store_true",
+                        help="Optional. Create the missing Fakturoid subjects of all records before transferring the records.")
+    parser.add_argument("--subject-concurrency",
+                        type=int,
+                        metavar="N",
+                        dest="subject_concurrency",
+                        default=4,
+                        help="Optional. Number of subjects created concurrently by --reconcile-subjects (default 4).")
+    parser.add_argument("--defer-payments",
+                        dest="defer_payments",
+                        default=False,
+                        action="store_true",
+                        help="Optional. Create all records first and mark them as paid afterwards, the payments are queued in the journal.")
+    parser.add_argument("--payment-concurrency",
+                        type=int,
+                        metavar="N",
+                        dest="payment_concurrency",
+                        default=4,
+                        help="Optional. Number of queued payments sent concurrently (default 4).")
+    parser.add_argument("--fakturoid-concurrency",
+                        type=int,
+                        metavar="N",
+                        dest="fakturoid_concurrency",
+                        default=4,
+                        help="Optional. Number of Fakturoid pages loaded or revalidated concurrently (default 4).")
+    parser.add_argument("--stream",
+                        dest="stream",
+                        default=False,
+                        action="store_true",
+                        help="Optional. Transfer iDoklad invoices and expenses page by page while they are being loaded.")
+    parser.add_argument("--workers",
+                        type=int,
+                        metavar="N",
+                        dest="workers",
+                        default=1,
+                        help="Optional. Number of records transferred concurrently (default 1).")
+    parser.add_argument("--prefetch-attachments",
+                        type=int,
+                        metavar="N",
+                        dest="prefetch_attachments",
+                        default=0,
+                        help="Optional. Number of records whose iDoklad attachments are downloaded ahead of the transfer (default 0).")
+    parser.add_argument("--prefetch-memory-budget",
+                        type=int,
+                        metavar="BYTES",
+                        dest="prefetch_memory_budget",
+                        default=PREFETCH_MEMORY_BUDGET,
+                        help="Optional. Maximum size of downloaded attachments waiting for or in the transfer, downloads already running can exceed it (default {}).".format(PREFETCH_MEMORY_BUDGET))
+    parser.add_argument("--rate-limit",
+                        type=float,
+                        metavar="N",
+                        dest="rate_limit",
+                        default=RATE_LIMIT_PER_SECOND,
+                        help="Optional. Initial number of requests per second for each API host, adjusted from the rate limit response headers (default unthrottled, halved on every 429 until the host sends them).")
+    parser.add_argument("--compress-cache",
+                        dest="compress_cache",
+                        default=False,
+                        action="store_true",
+                        help="Optional. Compress the pages stored in the Fakturoid API cache.")
+    parser.add_argument("--idoklad-incremental",
+                        dest="idoklad_incremental",
+                        default=False,
+                        action="store_true",
+                        help="Optional. Load only the iDoklad invoices and expenses changed since the last complete run.")
+    parser.add_argument("--fakturoid-delta",
+                        dest="fakturoid_delta",
+                        default=False,
+                        action="store_true",
+                        help="Optional. Keep the Fakturoid invoices and expenses in the cache and load only the ones updated since the last run.")
+
+    args = parser.parse_args(sys.argv[1:] if argv is None else argv)
+
+    # The export does not touch Fakturoid, so its credentials are only needed for the transfer
+    if not args.export_only:
+        missing = [
+            flag
+            for flag, value in [
+                ("--fakturoid-account", args.fakturoid_account_name),
+                ("--fakturoid-email", args.fakturoid_email),
+                ("--fakturoid-api-key", args.fakturoid_api_key),
+            ]
+            if not value
+        ]
+
+        if missing:
+            parser.error("the following arguments are required: " + ", ".join(missing))
+
+    return args
+
+
+def subject_full_name(idoklad_subject):
+    return " ".join([
+        idoklad_subject.firstname,
+        idoklad_subject.surname,
+    ]).strip()
+
+
+SUBJECT_MAPPING = {
+    "type": Argument("type"),
+    "name": "company_name",
+    "street": "street",
+    "city": "city",
+    "zip": "postal_code",
+    "country": "country_code",
+    "registration_no": "identification_number",
+    "vat_no": "vat_identification_number",
+    "local_vat_no": "vat_identification_number_sk",
+    "enabled_reminders": Constant(False),
+    "full_name": Computed(subject_full_name),
+    "email": "email",
+    "phone": "mobile",
+    "web": "www",
+}
+
+make_subject = compile_mapping(SUBJECT_MAPPING, ["type"], name="make_subject")
 
 
 def make_attachment(base64):
@@ -87,178 +280,295 @@ def make_attachment(base64):
 
 
 def find_fakturoid_payment_method(idoklad_record):
-    if idoklad_record["PaymentOption"]["Code"] in PAYMENT_METHOD_IDOKLAD_TO_FAKTUROID:
-        return PAYMENT_METHOD_IDOKLAD_TO_FAKTUROID[idoklad_record["PaymentOption"]["Code"]]
+    if idoklad_record.payment_option_code in PAYMENT_METHOD_IDOKLAD_TO_FAKTUROID:
+        return PAYMENT_METHOD_IDOKLAD_TO_FAKTUROID[idoklad_record.payment_option_code]
     else:
         raise Exception(
             ERROR_MESSAGES["unknown_payment_method"].format(
-                idoklad_record["PaymentOption"]["Code"],
-                idoklad_record["DocumentNumber"],
+                idoklad_record.payment_option_code,
+                idoklad_record.document_number,
             )
         )
 
 
-def find_fakturoid_subject_id(fakturoid_subjects, idoklad_purchaser):
-    for subject in fakturoid_subjects:
-        if subject["registration_no"] == idoklad_purchaser["IdentificationNumber"]:
-            return subject["id"]
+def normalize_bank_account_number(number):
+    if number is None:
+        return None
+
+    return "".join(number.split())
+
+
+def subject_index_key(fakturoid_subject):
+    return fakturoid_subject["registration_no"]
+
+
+def record_index_key(fakturoid_record):
+    return fakturoid_record["number"]
+
+
+def bank_account_index_key(fakturoid_bank_account):
+    return normalize_bank_account_number(fakturoid_bank_account["number"])
+
+
+def add_to_index(index, key, item):
+    # Keep the first item for duplicate keys, the same one a linear scan would find.
+    # Empty keys are not indexed, contacts without a registration number would all match each other
+    if key and key not in index:
+        index[key] = item
+
+
+def make_index(items, key):
+    index = {}
+
+    for item in items:
+        add_to_index(index, key(item), item)
+
+    return index
+
+
+def make_fakturoid_indexes(
+    fakturoid_invoices,
+    fakturoid_expenses,
+    fakturoid_subjects,
+    fakturoid_bank_accounts,
+):
+    return {
+        "invoices": make_index(fakturoid_invoices, record_index_key),
+        "expenses": make_index(fakturoid_expenses, record_index_key),
+        "subjects": make_index(fakturoid_subjects, subject_index_key),
+        "bank_accounts": make_index(fakturoid_bank_accounts, bank_account_index_key),
+    }
+
+
+def find_fakturoid_subject_id(fakturoid_subjects_index, idoklad_purchaser):
+    subject = fakturoid_subjects_index.get(idoklad_purchaser.identification_number)
+
+    if subject:
+        return subject["id"]
 
     return False
 
 
-def find_fakturoid_bank_account_id(fakturoid_bank_accounts, idoklad_record):
+def find_fakturoid_bank_account_id(fakturoid_bank_accounts_index, idoklad_record):
     idoklad_bank_account = "/".join([
-        idoklad_record["MyCompanyDocumentAddress"]["AccountNumber"],
-        idoklad_record["MyCompanyDocumentAddress"]["BankNumberCode"]
+        idoklad_record.my_company.account_number,
+        idoklad_record.my_company.bank_number_code
     ])
 
-    for bank_account in fakturoid_bank_accounts:
-        if bank_account["number"] == idoklad_bank_account:
-            return bank_account["id"]
+    bank_account = fakturoid_bank_accounts_index.get(
+        normalize_bank_account_number(idoklad_bank_account),
+    )
+
+    if bank_account:
+        return bank_account["id"]
 
     raise Exception(
         ERROR_MESSAGES['bank_account_not_found'].format(
             idoklad_bank_account,
-            idoklad_record["DocumentNumber"],
+            idoklad_record.document_number,
         )
     )
 
 
-def convert_record_lines(idoklad_lines):
-    lines = []
+def is_rounding_line(item):
+    return item.code == "ZaokPol" and item.total_price == 0
+
+
+def invoice_language(language_code):
+    language = language_code.split("-")[0].lower()
+
+    return "cz" if language == "cs" else language
+
+
+def expense_number(document_number):
+    return document_number.replace("DF", "N")
+
+
+LINE_MAPPING = {
+    "name": "name",
+    "quantity": "amount",
+    "unit_name": "unit",
+    "unit_price": "unit_price",
+    "vat_rate": "vat_rate",
+}
+
+# Skip artificial rounding items
+convert_record_lines = compile_mapping(LINE_MAPPING, skip=is_rounding_line, name="convert_line").batch
+
+INVOICE_MAPPING = {
+    "number": "document_number",
+    "variable_symbol": "variable_symbol",
+    "subject_id": Argument("fakturoid_subject_id"),
+    "order_number": "order_number",
+    "issued_on": "date_of_issue",
+    "taxable_fulfillment_due": "date_of_taxing",
+    "due": "maturity",
+    "note": "items_text_prefix",
+    "footer_note": "items_text_suffix",
+    "private_note": "note",
+    "iban": "my_company.iban",
+    "swift_bic": "my_company.swift",
+    "payment_method": Argument("fakturoid_payment_method"),
+    "currency": "currency_code",
+    "exchange_rate": "exchange_rate",
+    "language": Computed(invoice_language, "language_code"),
+    "lines": Computed(convert_record_lines, "lines"),
+    "bank_account": Optional(Argument("fakturoid_bank_account_id")),
+    "attachment": Optional(Argument("fakturoid_attachment")),
+}
+
+convert_invoice = compile_mapping(
+    INVOICE_MAPPING,
+    [
+        "fakturoid_subject_id",
+        "fakturoid_payment_method",
+        "fakturoid_attachment",
+        "fakturoid_bank_account_id",
+    ],
+    name="convert_invoice",
+)
+
+EXPENSE_MAPPING = {
+    "number": Computed(expense_number, "document_number"),
+    "original_number": "received_document_number",
+    "variable_symbol": "variable_symbol",
+    "subject_id": Argument("fakturoid_subject_id"),
+    "document_type": Constant("invoice"),
+    "issued_on": "date_of_receiving",
+    "taxable_fulfillment_due": "date_of_receiving",
+    "due_on": "date_of_payment",
+    "description": "description",
+    "private_note": "note",
+    "payment_method": Argument("fakturoid_payment_method"),
+    "hide_bank_account": Constant(True),
+    "currency": "currency_code",
+    "exchange_rate": "exchange_rate",
+    "lines": Computed(convert_record_lines, "lines"),
+    "attachment": Optional(Argument("fakturoid_attachment")),
+}
+
+convert_expense = compile_mapping(
+    EXPENSE_MAPPING,
+    [
+        "fakturoid_subject_id",
+        "fakturoid_payment_method",
+        "fakturoid_attachment",
+    ],
+    name="convert_expense",
+)
+
+
+def record_already_transfered(fakturoid_records_index, idoklad_number):
+    return idoklad_number in fakturoid_records_index
+
+
+def print_vat_mismatch(fakturoid_vat_no, idoklad_record, type, decision):
+    print(
+        "WARNING: Your Fakturoid VAT Number ({fakturoid_vat_no}) does not match the iDoklad {type} ({record_number}) VAT Number ({record_vat_no}), {decision}. You can change it in the web app.".format(
+            fakturoid_vat_no=fakturoid_vat_no,
+            type=type,
+            record_number=idoklad_record.document_number,
+            record_vat_no=idoklad_record.my_company.vat_identification_number,
+            decision=decision,
+        )
+    )
 
-    for item in idoklad_lines:
-        if "Code" in item and item["Code"] == "ZaokPol" and item["TotalPrice"] == 0:
-            continue  # Skip artificial rounding item
 
-        lines.append({
-            "name": item["Name"],
-            "quantity": item["Amount"],
-            "unit_name": item["Unit"],
-            "unit_price": item["UnitPrice"],
-            "vat_rate": item["VatRate"],
-        })
+def load_vat_mismatch_policies(path):
+    with open(path) as file:
+        policies = json.load(file)
 
-    return lines
+    for type in ("invoice", "expense"):
+        for number, policy in policies.get(type, {}).items():
+            if not policy in VAT_MISMATCH_POLICIES:
+                raise Exception(
+                    ERROR_MESSAGES["invalid_vat_mismatch_policy"].format(policy, type, number)
+                )
 
+    return policies
 
-def convert_invoice(
-    idoklad_invoice,
-    fakturoid_subject_id,
-    fakturoid_payment_method,
-    fakturoid_attachment,
-    fakturoid_bank_account_id,
-):
-    language = "cz"
-    langauge_code = idoklad_invoice["LanguageCode"]
-
-    if langauge_code.split("-")[0].lower() != "cs":
-        language = langauge_code.split("-")[0].lower()
-
-    result = {
-        "number": idoklad_invoice["DocumentNumber"],
-        "variable_symbol": idoklad_invoice["VariableSymbol"],
-        "subject_id": fakturoid_subject_id,
-        "order_number": idoklad_invoice["OrderNumber"],
-        "issued_on": idoklad_invoice["DateOfIssue"],
-        "taxable_fulfillment_due": idoklad_invoice["DateOfTaxing"],
-        "due": idoklad_invoice["Maturity"],
-        "note": idoklad_invoice["ItemsTextPrefix"],
-        "footer_note": idoklad_invoice["ItemsTextSuffix"],
-        "private_note": idoklad_invoice["Note"],
-        "iban": idoklad_invoice["MyCompanyDocumentAddress"]["Iban"],
-        "swift_bic": idoklad_invoice["MyCompanyDocumentAddress"]["Swift"],
-        "payment_method": fakturoid_payment_method,
-        "currency": idoklad_invoice["Currency"]["Code"],
-        "exchange_rate": idoklad_invoice["ExchangeRate"],
-        "language": language,
-        "lines": convert_record_lines(idoklad_invoice['IssuedInvoiceItems']),
-    }
 
-    if fakturoid_bank_account_id:
-        result["bank_account"] = fakturoid_bank_account_id
+class VatMismatchPolicy(object):
+    def __init__(self, fakturoid_vat_no, policy, record_policies=None):
+        self.fakturoid_vat_no = fakturoid_vat_no
+        self.policy = policy
+        self.record_policies = record_policies or {}
+        # Answers of the check before the transfer, by (type, iDoklad id)
+        self.decisions = {}
 
-    if fakturoid_attachment:
-        result["attachment"] = fakturoid_attachment
+    def requires_check(self):
+        # accept and skip are decided record by record, only ask and abort need all mismatches up front
+        policies = [self.policy] + [
+            policy
+            for type_policies in self.record_policies.values()
+            for policy in type_policies.values()
+        ]
 
-    return result
+        return "ask" in policies or "abort" in policies
 
+    def matches(self, idoklad_record):
+        return self.fakturoid_vat_no == idoklad_record.my_company.vat_identification_number
 
-def convert_expense(
-    idoklad_expense,
-    fakturoid_subject_id,
-    fakturoid_payment_method,
-    fakturoid_attachment,
-):
-    result = {
-        "number": idoklad_expense["DocumentNumber"].replace("DF", "N"),
-        "original_number": idoklad_expense["ReceivedDocumentNumber"],
-        "variable_symbol": idoklad_expense["VariableSymbol"],
-        "subject_id": fakturoid_subject_id,
-        "document_type": "invoice",
-        "issued_on": idoklad_expense["DateOfReceiving"],
-        "taxable_fulfillment_due": idoklad_expense["DateOfReceiving"],
-        "due_on": idoklad_expense["DateOfPayment"],
-        "description": idoklad_expense["Description"],
-        "private_note": idoklad_expense["Note"],
-        "payment_method": fakturoid_payment_method,
-        "hide_bank_account": True,
-        "currency": idoklad_expense["Currency"]["Code"],
-        "exchange_rate": idoklad_expense["ExchangeRate"],
-        "lines": convert_record_lines(idoklad_expense['Items']),
-    }
+    def get_policy(self, type, idoklad_record):
+        return self.record_policies.get(type, {}).get(idoklad_record.document_number, self.policy)
 
-    if fakturoid_attachment:
-        result["attachment"] = fakturoid_attachment
+    def decide(self, type, idoklad_record):
+        if self.matches(idoklad_record):
+            return "accept"
 
-    return result
+        decision = self.decisions.get((type, idoklad_record.id)) or self.get_policy(type, idoklad_record)
 
+        # Nobody is asked during the transfer, records the check did not see are skipped (--stream)
+        return decision if decision == "accept" else "skip"
 
-def record_already_transfered(fakturoid_records, idoklad_number):
-    for record in fakturoid_records:
-        if record["number"] == idoklad_number:
-            return True
 
-    return False
+def check_vat_numbers(idoklad_records, fakturoid_indexes, vat_policy, journal=None):
+    # Decides the mismatches marked ask or abort before the transfer, so the transfer never waits for an answer
+    asked = []
+    aborted = 0
 
+    print("--- Checking VAT numbers")
 
-def fakturoid_vat_matches_record_vat_or_continue(
-    fakturoid_vat_no,
-    record_vat_no,
-    record_number,
-    type,
-):
-    if fakturoid_vat_no == record_vat_no:
-        return True
+    for type, records in idoklad_records:
+        fakturoid_records_index = fakturoid_indexes["invoices" if type == "invoice" else "expenses"]
 
-    print(
-        "\nWARNING: Your Fakturoid VAT Number ({fakturoid_vat_no}) does not match the iDoklad {type} ({record_invoice_number}) VAT Number ({record_vat_no}). You can change it in the web app.".format(
-            fakturoid_vat_no=fakturoid_vat_no,
-            type=type,
-            record_invoice_number=record_number,
-            record_vat_no=record_vat_no,
-        )
-    )
+        for idoklad_record in records:
+            if vat_policy.matches(idoklad_record):
+                continue
 
-    answer = input("Do you want to continue anyway? [yes/no]: ")
+            policy = vat_policy.get_policy(type, idoklad_record)
 
-    if answer == "y" or answer == "yes":
-        return True
+            if not policy in ("ask", "abort"):
+                continue
 
-    return False
+            if record_already_transfered(fakturoid_records_index, idoklad_record.document_number):
+                continue
 
+            journal_entry = journal.get(type, idoklad_record.id) if journal else None
 
-def export_pdf(type, filename, base64_record):
-    file_path = "{root_dir}/{type_dir}/{filename}.pdf".format(
-        root_dir=EXPORT_DIRECTORY,
-        type_dir=EXPORT_INVOICE_DIRECTORY if type == 'invoice' else EXPORT_EXPENSE_DIRECTORY,
-        filename=filename,
-    )
+            # Records journaled as created only need to be paid
+            if journal_entry and not journal_entry["stage"] == JOURNAL_STAGE_SUBJECT:
+                continue
 
-    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+            print_vat_mismatch(vat_policy.fakturoid_vat_no, idoklad_record, type, policy)
 
-    with open(file_path, "wb") as file:
-        file.write(base64.b64decode(base64_record))
+            if policy == "abort":
+                aborted += 1
+            else:
+                asked.append((type, idoklad_record.id))
+
+    if aborted:
+        raise Exception(ERROR_MESSAGES["vat_number_mismatch"].format(aborted))
+
+    if asked:
+        answer = input(
+            "Do you want to transfer the {} records marked ask anyway? [yes/no]: ".format(len(asked))
+        )
+
+        for key in asked:
+            vat_policy.decisions[key] = "accept" if answer == "y" or answer == "yes" else "skip"
+
+    print("{} records with a different VAT number marked ask".format(len(asked)))
 
 
 def process_record(
@@ -266,87 +576,152 @@ def process_record(
     idoklad_record,
     fakturoid,
     fakturoid_account,
-    fakturoid_subjects,
-    fakturoid_bank_accounts,
-    fakturoid_records,
+    fakturoid_subjects_index,
+    fakturoid_bank_accounts_index,
+    fakturoid_records_index,
     type,
-    disable_vat_number_check,
-    export_idoklad_as_pdf,
+    vat_policy=None,
+    subject_locks=None,
+    journal=None,
+    prefetched_attachment=None,
+    tracer=NULL_TRACER,
+    defer_payments=False,
 ):
     if not type == "invoice" and not type == "expense":
         raise Exception(
             ERROR_MESSAGES['unknown_record_type'].format(type)
         )
 
-    if record_already_transfered(fakturoid_records, idoklad_record["DocumentNumber"]):
+    stage_args = {"type": type, "number": idoklad_record.document_number}
+
+    with tracer.span("dedupe", "stage", **stage_args):
+        journal_entry = journal.get(type, idoklad_record.id) if journal else None
+        journal_finished = journal_entry and journal_record_finished(journal_entry, idoklad_record)
+        already_transfered = record_already_transfered(
+            fakturoid_records_index,
+            idoklad_record.document_number,
+        )
+
+    if journal_finished:
         print(
-            "--- {type} number {number} already transfered".format(
+            "--- {type} number {number} already transfered (journal)".format(
                 type=type.capitalize(),
-                number=idoklad_record["DocumentNumber"],
+                number=idoklad_record.document_number,
             )
         )
 
         return 'continue'
 
-    if not disable_vat_number_check:
-        vat_numbers_match_or_continue = fakturoid_vat_matches_record_vat_or_continue(
-            fakturoid_account["vat_no"],
-            idoklad_record["MyCompanyDocumentAddress"]["VatIdentificationNumber"],
-            idoklad_record["DocumentNumber"],
-            type,
+    if journal_entry and journal_entry["stage"] == JOURNAL_STAGE_CREATED:
+        print(
+            "--- Resuming iDoklad {type} {number}, created but not paid".format(
+                type=type,
+                number=idoklad_record.document_number,
+            )
         )
 
-        if not vat_numbers_match_or_continue:
-            return 'break'
+        with tracer.span("pay", "stage", **stage_args):
+            pay_or_queue_fakturoid_record(
+                fakturoid,
+                idoklad_record,
+                journal_entry["fakturoid_id"],
+                type,
+                journal,
+                defer_payments,
+            )
+
+        return 'continue'
+
+    if already_transfered:
+        print(
+            "--- {type} number {number} already transfered".format(
+                type=type.capitalize(),
+                number=idoklad_record.document_number,
+            )
+        )
+
+        return 'continue'
+
+    if vat_policy:
+        with tracer.span("vat_check", "stage", **stage_args):
+            vat_decision = vat_policy.decide(type, idoklad_record)
+
+        if not vat_policy.matches(idoklad_record):
+            print_vat_mismatch(vat_policy.fakturoid_vat_no, idoklad_record, type, vat_decision)
+
+        if vat_decision == "skip":
+            return 'skip'
 
     result = {}
-    idoklad_subject_type = "Purchaser" if type == "invoice" else "Supplier"
 
     print(
         "--- Processing iDoklad {type} {number}".format(
             type=type,
-            number=idoklad_record["DocumentNumber"],
+            number=idoklad_record.document_number,
         )
     )
 
-    if export_idoklad_as_pdf:
-        print("Exporting as PDF")
+    record_fakturoid_attachment = None
 
-        base64_idoklad_record = idoklad.get_pdf(
-            type,
-            idoklad_record["Id"],
-        )
+    if not idoklad_record.attachment_file_name == "":
+        with tracer.span("attachment", "stage", prefetched=bool(prefetched_attachment), **stage_args) as span:
+            idoklad_attachment = prefetched_attachment
 
-        export_pdf(
-            type, idoklad_record["DocumentNumber"], base64_idoklad_record)
+            if not idoklad_attachment:
+                print("Loading attachment")
 
-    record_fakturoid_attachment = None
+                idoklad_attachment = idoklad.get_attachment(
+                    type,
+                    idoklad_record.id,
+                    idoklad_record.attachment_file_name,
+                )
 
-    if not idoklad_record["AttachmentFileName"] == "":
-        print("Loading attachment")
+            if idoklad_attachment:
+                record_fakturoid_attachment = make_attachment(idoklad_attachment)
+                span["bytes"] = len(idoklad_attachment)
 
-        idoklad_attachment = idoklad.get_attachment(
-            type,
-            idoklad_record["Id"],
+    subject_lock = nullcontext()
+
+    if subject_locks:
+        subject_lock = subject_locks.lock(
+            idoklad_record.subject.identification_number,
         )
 
-        if idoklad_attachment:
-            record_fakturoid_attachment = make_attachment(idoklad_attachment)
+    with tracer.span("subject", "stage", **stage_args) as span, subject_lock:
+        record_fakturoid_subject_id = False
 
-    record_fakturoid_subject_id = find_fakturoid_subject_id(
-        fakturoid_subjects,
-        idoklad_record[idoklad_subject_type],
-    )
+        if journal_entry and journal_entry["stage"] == JOURNAL_STAGE_SUBJECT:
+            record_fakturoid_subject_id = journal_entry["fakturoid_subject_id"]
+        else:
+            record_fakturoid_subject_id = find_fakturoid_subject_id(
+                fakturoid_subjects_index,
+                idoklad_record.subject,
+            )
 
-    if not record_fakturoid_subject_id:
-        subject_type = 'customer' if type == 'invoice' else 'supplier'
-        subject_object = make_subject(
-            idoklad_record[idoklad_subject_type],
-            subject_type,
+        if not record_fakturoid_subject_id:
+            subject_type = 'customer' if type == 'invoice' else 'supplier'
+            subject_object = make_subject(
+                idoklad_record.subject,
+                subject_type,
+            )
+            fakturoid_subject = fakturoid.create_subject(subject_object)
+            record_fakturoid_subject_id = fakturoid_subject["id"]
+            result["fakturoid_subject"] = fakturoid_subject
+            span["created"] = True
+
+            add_to_index(
+                fakturoid_subjects_index,
+                subject_index_key(fakturoid_subject),
+                fakturoid_subject,
+            )
+
+    if journal:
+        journal.record_subject(
+            type,
+            idoklad_record.id,
+            idoklad_record.document_number,
+            record_fakturoid_subject_id,
         )
-        fakturoid_subject = fakturoid.create_subject(subject_object)
-        record_fakturoid_subject_id = fakturoid_subject["id"]
-        result["fakturoid_subject"] = fakturoid_subject
 
     record_fakturoid_payment_method = find_fakturoid_payment_method(
         idoklad_record,
@@ -356,34 +731,52 @@ def process_record(
 
     if record_fakturoid_payment_method == "B":
         record_fakturoid_bank_account_id = find_fakturoid_bank_account_id(
-            fakturoid_bank_accounts,
+            fakturoid_bank_accounts_index,
             idoklad_record,
         )
 
-    fakturoid_record = {}
-
-    if type == 'invoice':
-        fakturoid_record = fakturoid.create_invoice(
-            convert_invoice(
+    with tracer.span("convert", "stage", **stage_args):
+        if type == 'invoice':
+            fakturoid_record_object = convert_invoice(
                 idoklad_record,
                 record_fakturoid_subject_id,
                 record_fakturoid_payment_method,
                 record_fakturoid_attachment,
                 record_fakturoid_bank_account_id,
             )
-        )
-    else:
-        fakturoid_record = fakturoid.create_expense(
-            convert_expense(
+        else:
+            fakturoid_record_object = convert_expense(
                 idoklad_record,
                 record_fakturoid_subject_id,
                 record_fakturoid_payment_method,
                 record_fakturoid_attachment,
             )
-        )
+
+    fakturoid_record = {}
+
+    with tracer.span("create", "stage", **stage_args):
+        if type == 'invoice':
+            fakturoid_record = fakturoid.create_invoice(fakturoid_record_object)
+        else:
+            fakturoid_record = fakturoid.create_expense(fakturoid_record_object)
 
     result["fakturoid_record"] = fakturoid_record
 
+    if journal:
+        journal.record_created(
+            type,
+            idoklad_record.id,
+            idoklad_record.document_number,
+            record_fakturoid_subject_id,
+            fakturoid_record["id"],
+        )
+
+    add_to_index(
+        fakturoid_records_index,
+        record_index_key(fakturoid_record),
+        fakturoid_record,
+    )
+
     print(
         "Created Fakturoid {type} {number}".format(
             type=type,
@@ -391,21 +784,281 @@ def process_record(
         )
     )
 
-    if not idoklad_record["DateOfPayment"] == "":
-        payload = {}
+    if not idoklad_record.date_of_payment == "":
+        with tracer.span("pay", "stage", **stage_args):
+            pay_or_queue_fakturoid_record(
+                fakturoid,
+                idoklad_record,
+                fakturoid_record["id"],
+                type,
+                journal,
+                defer_payments,
+            )
 
-        if type == "invoice":
-            payload = {"paid_at": idoklad_record["DateOfPayment"]}
-        else:
-            payload = {"paid_on": idoklad_record["DateOfPayment"]}
+    return result
+
+
+def make_payment_payload(idoklad_record, type):
+    if type == "invoice":
+        return {"paid_at": idoklad_record.date_of_payment}
+
+    return {"paid_on": idoklad_record.date_of_payment}
+
+
+def pay_or_queue_fakturoid_record(fakturoid, idoklad_record, fakturoid_record_id, type, journal=None, defer_payments=False):
+    if not defer_payments or not journal:
+        pay_fakturoid_record(fakturoid, idoklad_record, fakturoid_record_id, type, journal)
+
+        return
+
+    journal.queue_payment(
+        type,
+        idoklad_record.id,
+        idoklad_record.document_number,
+        fakturoid_record_id,
+        make_payment_payload(idoklad_record, type),
+    )
+
+    print(
+        "Queued payment of Fakturoid {type} {number}".format(
+            type=type,
+            number=idoklad_record.document_number,
+        )
+    )
+
+
+def pay_fakturoid_record(fakturoid, idoklad_record, fakturoid_record_id, type, journal=None):
+    fakturoid.pay_record(type, fakturoid_record_id, make_payment_payload(idoklad_record, type))
+
+    if journal:
+        journal.record_paid(type, idoklad_record.id)
+
+    print(
+        "Paid Fakturoid {type} {number}".format(
+            type=type,
+            number=idoklad_record.document_number,
+        )
+    )
+
+
+def transfer_records(
+    idoklad,
+    idoklad_records,
+    fakturoid,
+    fakturoid_account,
+    fakturoid_indexes,
+    type,
+    vat_policy=None,
+    workers=1,
+    subject_locks=None,
+    journal=None,
+    watermark=None,
+    prefetch=0,
+    prefetch_memory_budget=PREFETCH_MEMORY_BUDGET,
+    tracer=NULL_TRACER,
+    defer_payments=False,
+):
+    fakturoid_records_index = fakturoid_indexes["invoices" if type == "invoice" else "expenses"]
+    state = {"created": 0, "skipped": 0}
+
+    def should_prefetch(idoklad_record):
+        if record_already_transfered(fakturoid_records_index, idoklad_record.document_number):
+            return False
+
+        journal_entry = journal.get(type, idoklad_record.id) if journal else None
 
-        fakturoid.pay_record(type, fakturoid_record["id"], payload)
+        # Records journaled as created only need to be paid
+        return not journal_entry or journal_entry["stage"] == JOURNAL_STAGE_SUBJECT
+
+    budget = PrefetchBudget(prefetch_memory_budget) if prefetch else None
+
+    def process(item):
+        idoklad_record, prefetched_attachment = item
+
+        try:
+            return transfer_record(idoklad_record, prefetched_attachment)
+        finally:
+            if budget:
+                budget.release(len(prefetched_attachment or ""))
+
+    def transfer_record(idoklad_record, prefetched_attachment):
+        with tracer.span(
+            "{} {}".format(type, idoklad_record.document_number),
+            type=type,
+            number=idoklad_record.document_number,
+            lines=len(idoklad_record.lines),
+            attachment=idoklad_record.attachment_file_name,
+        ) as span:
+            result = process_record(
+                idoklad,
+                idoklad_record,
+                fakturoid,
+                fakturoid_account,
+                fakturoid_indexes["subjects"],
+                fakturoid_indexes["bank_accounts"],
+                fakturoid_records_index,
+                type,
+                vat_policy,
+                subject_locks,
+                journal,
+                prefetched_attachment,
+                tracer,
+                defer_payments,
+            )
+            span["result"] = result if isinstance(result, str) else "created"
+
+        if watermark:
+            # Skipped records are listed again by the next incremental run
+            if result == 'skip':
+                watermark.abort()
+            else:
+                watermark.observe(idoklad_record)
+
+        return result
+
+    def collect(result):
+        if result == 'continue':
+            return
+
+        if result == 'skip':
+            state["skipped"] += 1
+
+            return
+
+        state["created"] += 1
+
+    if prefetch:
+        items = prefetch_attachments(
+            idoklad,
+            idoklad_records,
+            type,
+            prefetch,
+            budget,
+            should_prefetch,
+        )
+    else:
+        items = ((idoklad_record, None) for idoklad_record in idoklad_records)
+
+    if workers <= 1:
+        for item in items:
+            collect(process(item))
+
+        return state
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = set()
+
+        for item in items:
+            # Keep the number of queued records bounded, so streamed pages are not all buffered
+            if len(pending) >= workers * 2:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+
+                for future in done:
+                    collect(future.result())
+
+            pending.add(executor.submit(process, item))
+
+        done, pending = wait(pending)
+
+        for future in done:
+            collect(future.result())
+
+    return state
+
+
+def reconcile_subjects(fakturoid, idoklad_records, fakturoid_indexes, journal=None, workers=1, vat_policy=None):
+    fakturoid_subjects_index = fakturoid_indexes["subjects"]
+    missing_subjects = {}
+
+    print("--- Fakturoid - reconciling subjects")
+
+    for type, records in idoklad_records:
+        fakturoid_records_index = fakturoid_indexes["invoices" if type == "invoice" else "expenses"]
+
+        for idoklad_record in records:
+            if record_already_transfered(fakturoid_records_index, idoklad_record.document_number):
+                continue
+
+            # Journaled records have their subject already
+            if journal and journal.get(type, idoklad_record.id):
+                continue
+
+            if vat_policy and vat_policy.decide(type, idoklad_record) == "skip":
+                continue
+
+            key = idoklad_record.subject.identification_number
+
+            # Contacts without a registration number cannot be told apart here, the record creates its own
+            if not key:
+                continue
+
+            if key in fakturoid_subjects_index or key in missing_subjects:
+                continue
+
+            missing_subjects[key] = make_subject(
+                idoklad_record.subject,
+                'customer' if type == 'invoice' else 'supplier',
+            )
+
+    print("Creating {} missing subjects".format(len(missing_subjects)))
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for fakturoid_subject in executor.map(fakturoid.create_subject, missing_subjects.values()):
+            add_to_index(
+                fakturoid_subjects_index,
+                subject_index_key(fakturoid_subject),
+                fakturoid_subject,
+            )
+
+    return len(missing_subjects)
+
+
+def pay_queued_records(fakturoid, journal, workers=1, tracer=NULL_TRACER):
+    payments = journal.get_queued_payments()
+    state = {"paid": 0, "failed": 0}
+
+    if not payments:
+        return state
+
+    print("--- Paying {} queued Fakturoid records".format(len(payments)))
+
+    def pay(payment):
+        with tracer.span("pay", "stage", type=payment["type"], number=payment["number"]):
+            try:
+                fakturoid.pay_record(payment["type"], payment["fakturoid_id"], payment["payload"])
+            except Exception as e:
+                # The record exists in Fakturoid already, only the payment is tried again by the next run
+                journal.payment_failed(payment["type"], payment["idoklad_id"], str(e))
+
+                print(
+                    "Paying Fakturoid {type} {number} failed, it stays queued: {error}".format(
+                        type=payment["type"],
+                        number=payment["number"],
+                        error=e,
+                    )
+                )
+
+                return False
+
+        journal.record_paid(payment["type"], payment["idoklad_id"])
 
         print(
             "Paid Fakturoid {type} {number}".format(
-                type=type,
-                number=fakturoid_record["number"],
+                type=payment["type"],
+                number=payment["number"],
             )
         )
 
-    return result
+        return True
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for paid in executor.map(pay, payments):
+            state["paid" if paid else "failed"] += 1
+
+    print(
+        "Paid {paid} queued records, {failed} failed and stay queued for the next run".format(
+            **state
+        )
+    )
+
+    return state
@@ -1,115 +1,287 @@
+import time
 import requests
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter, DEFAULT_POOLSIZE
 
-from constants import ERROR_MESSAGES
+from constants import (
+    ERROR_MESSAGES,
+    IDOKLAD_API_URL,
+    IDOKLAD_PAGE_SIZE,
+    IDOKLAD_PAGE_SIZE_MIN,
+    IDOKLAD_PAGE_SIZE_MAX,
+    IDOKLAD_PAGE_TARGET_BYTES,
+    IDOKLAD_PAGE_TARGET_SECONDS,
+    IDOKLAD_PAGE_RETRIES,
+    IDOKLAD_INVOICE_FIELDS,
+    IDOKLAD_EXPENSE_FIELDS,
+)
+from request_scheduler import RequestScheduler
+from idoklad_records import IDokladRecordParser
+import json_codec
 
 
 class IDokladAPI(object):
-    def __init__(self, oauth_client, filter):
+    def __init__(
+        self,
+        oauth_client,
+        filter,
+        concurrency=1,
+        scheduler=None,
+        attachment_cache=None,
+        api_url=IDOKLAD_API_URL,
+        metrics=None,
+        select_fields=False,
+        adaptive_page_size=False,
+    ):
         self.session = requests.Session()
         self.session.headers.update(
             {
-                "Authorization": "Bearer {access_token}".format(
-                    access_token=oauth_client.access_token
-                ),
                 "Accept": "application/json",
+                "Accept-Encoding": json_codec.ACCEPT_ENCODING,
             }
         )
+        adapter = HTTPAdapter(pool_maxsize=max(concurrency, DEFAULT_POOLSIZE))
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.oauth_client = oauth_client
         self.filter = filter
-        self.api_url = "https://api.idoklad.cz/v2"
+        self.concurrency = concurrency
+        self.scheduler = scheduler if scheduler else RequestScheduler()
+        self.attachment_cache = attachment_cache
+        self.metrics = metrics
+        self.api_url = api_url
+        self.select_fields = select_fields
+        self.adaptive_page_size = adaptive_page_size
+        self.parser = IDokladRecordParser()
+
+    def get_records(self, path, type, parse, changed_since=None, fields=None):
+        return list(self.iter_records(path, type, parse, changed_since, fields))
 
-    def get_records(self, path, type):
-        if self.filter:
-            path += "?filter={}".format(self.filter)
+    def iter_records(self, path, type, parse, changed_since=None, fields=None):
+        so_far = 0
+        filter = self.filter
 
-        page_search_param_prefix = "&" if self.filter else "?"
+        if changed_since:
+            print("--- iDoklad - loading {} invoices changed since {}".format(type, changed_since))
 
-        total_pages = 1
-        page = 1
-        result = []
+            changed_since_filter = "DateLastChange~gte~{}".format(changed_since)
+            filter = "|".join([filter, changed_since_filter]) if filter else changed_since_filter
+        else:
+            print("--- iDoklad - loading {} invoices".format(type))
 
-        print("--- iDoklad - loading {} invoices".format(type))
+        stats = {}
+        json_response = self.get_records_page(path, 1, filter, IDOKLAD_PAGE_SIZE, fields, stats)
+        total_pages = json_response["TotalPages"]
+        total_items = json_response["TotalItems"]
+        so_far += len(json_response["Data"])
 
-        while page <= total_pages:
-            whole_path = "/{path}{page_search_param_prefix}page={page}&pagesize={pagesize}".format(
-                page_search_param_prefix=page_search_param_prefix,
-                path=path,
-                page=page,
-                pagesize=50
-            )
+        print("Loaded {so_far} of {total} invoices".format(so_far=so_far, total=total_items))
+
+        yield from map(parse, json_response["Data"])
+
+        page_size = IDOKLAD_PAGE_SIZE
+        first_page = 2
+        loaded_ids = set()
+
+        if total_pages > 1 and self.adaptive_page_size:
+            page_size = adapt_page_size(len(json_response["Data"]), stats["bytes"], stats["seconds"])
+
+            if not page_size == IDOKLAD_PAGE_SIZE:
+                print("Continuing with page size {}".format(page_size))
+
+                # Pages of the new size start at other offsets, the first one can overlap the loaded records
+                first_page = so_far // page_size + 1
+                total_pages = (total_items + page_size - 1) // page_size
+                loaded_ids = set(record["Id"] for record in json_response["Data"])
+
+        if first_page <= total_pages:
+            # At most `concurrency` pages are downloaded ahead of the consumer
+            with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+                pending = deque()
+                next_page = first_page
 
-            print("Loading page {}".format(page))
+                while next_page <= total_pages or pending:
+                    while next_page <= total_pages and len(pending) < self.concurrency:
+                        pending.append(
+                            executor.submit(
+                                self.get_records_page,
+                                path,
+                                next_page,
+                                filter,
+                                page_size,
+                                fields,
+                            ),
+                        )
+                        next_page += 1
 
-            response = self._api_get(whole_path)
+                    json_response = pending.popleft().result()
 
-            if response.status_code == 200:
-                json_response = response.json()
-                result += json_response["Data"]
+                    if loaded_ids:
+                        json_response["Data"] = [
+                            record for record in json_response["Data"] if not record["Id"] in loaded_ids
+                        ]
 
-                print(
-                    "Loaded {so_far} of {total} invoices".format(
-                        so_far=len(result),
-                        total=json_response["TotalItems"]
+                    so_far += len(json_response["Data"])
+
+                    print(
+                        "Loaded {so_far} of {total} invoices".format(
+                            so_far=so_far,
+                            total=total_items,
+                        )
                     )
-                )
 
-                if page == 1:
-                    total_pages = json_response["TotalPages"]
+                    yield from map(parse, json_response["Data"])
+
+    def get_records_page(self, path, page, filter=None, page_size=IDOKLAD_PAGE_SIZE, fields=None, stats=None):
+        search_params = []
+
+        if filter:
+            search_params.append("filter={}&filtertype=and".format(filter))
+
+        search_params.append("page={}&pagesize={}".format(page, page_size))
+
+        if fields:
+            search_params.append("select={}".format(",".join(fields)))
+
+        whole_path = "/{path}?{search_params}".format(
+            path=path,
+            search_params="&".join(search_params),
+        )
+        attempt = 1
+
+        print("Loading page {}".format(page))
+
+        # 429 and 5xx responses are retried by the scheduler, only connection errors are retried here
+        while True:
+            started_at = time.monotonic()
+
+            try:
+                response = self._api_get(whole_path)
+            except requests.RequestException as e:
+                if attempt >= IDOKLAD_PAGE_RETRIES:
+                    raise
 
-                page += 1
-            else:
+                print("Loading page {} failed: {}, retrying".format(page, e))
+
+                time.sleep(attempt)
+                attempt += 1
+
+                continue
+
+            if not response.status_code == 200:
                 raise Exception(
                     ERROR_MESSAGES["request_failed"].format(
                         "GET", whole_path, response.status_code, response.text
                     ),
                 )
 
-        return result
+            if stats is not None:
+                stats["bytes"] = len(response.content)
+                stats["seconds"] = time.monotonic() - started_at
 
-    def get_invoices(self):
-        return self.get_records("IssuedInvoices/Expand", "issued")
+            return json_codec.response_json(response)
 
-    def get_expenses(self):
-        return self.get_records("ReceivedInvoices/Expand", "received")
+    def get_invoices(self, changed_since=None):
+        return self.get_records(
+            "IssuedInvoices/Expand",
+            "issued",
+            self.parser.parse_invoice,
+            changed_since,
+            IDOKLAD_INVOICE_FIELDS if self.select_fields else None,
+        )
 
-    def get_pdf(self, type, id):
-        if type == "invoice":
-            return self.get_invoice_pdf(id)
-        elif type == "expense":
-            return self.get_expense_pdf(id)
+    def get_expenses(self, changed_since=None):
+        return self.get_records(
+            "ReceivedInvoices/Expand",
+            "received",
+            self.parser.parse_expense,
+            changed_since,
+            IDOKLAD_EXPENSE_FIELDS if self.select_fields else None,
+        )
 
-        return None
+    def iter_invoices(self, changed_since=None):
+        return self.iter_records(
+            "IssuedInvoices/Expand",
+            "issued",
+            self.parser.parse_invoice,
+            changed_since,
+            IDOKLAD_INVOICE_FIELDS if self.select_fields else None,
+        )
 
-    def get_invoice_pdf(self, id):
-        path = "IssuedInvoices/{}/GetPdf?language=1".format(id)
-        response = self._api_get("/" + path)
+    def iter_expenses(self, changed_since=None):
+        return self.iter_records(
+            "ReceivedInvoices/Expand",
+            "received",
+            self.parser.parse_expense,
+            changed_since,
+            IDOKLAD_EXPENSE_FIELDS if self.select_fields else None,
+        )
 
-        if response.status_code == 200:
-            return response.json()
+    def iter_pdf(self, type, id, chunk_size):
+        if type == "invoice":
+            path = "IssuedInvoices/{}/GetPdf?language=1".format(id)
         else:
-            raise Exception(
-                ERROR_MESSAGES["request_failed"].format(
-                    "GET", path, response.status_code, response.text
-                ),
-            )
+            path = "ReceivedInvoices/{}/GetPdf?language=1".format(id)
 
-    def get_expense_pdf(self, id):
-        path = "ReceivedInvoices/{}/GetPdf?language=1".format(id)
-        response = self._api_get("/" + path)
+        if self.attachment_cache:
+            chunks = self.attachment_cache.iter_chunks(type, id, "GetPdf", chunk_size)
 
-        if response.status_code == 200:
-            return response.json()
-        else:
-            raise Exception(
-                ERROR_MESSAGES["request_failed"].format(
-                    "GET", path, response.status_code, response.text
-                ),
-            )
+            if chunks:
+                yield from chunks
+
+                return
+
+        response = self._api_get("/" + path, stream=True)
+
+        with response:
+            if not response.status_code == 200:
+                raise Exception(
+                    ERROR_MESSAGES["request_failed"].format(
+                        "GET", path, response.status_code, response.text
+                    ),
+                )
+
+            chunks = response.iter_content(chunk_size)
+
+            if self.metrics:
+                chunks = self.count_bytes_in("/" + path, chunks)
+
+            if not self.attachment_cache:
+                yield from chunks
+
+                return
+
+            writer = self.attachment_cache.writer(type, id, "GetPdf")
+
+            try:
+                for chunk in chunks:
+                    writer.write(chunk)
+
+                    yield chunk
+            except BaseException:
+                writer.discard()
+
+                raise
+
+            writer.commit()
 
-    def get_attachment(self, type, id):
+    def count_bytes_in(self, path, chunks):
+        bytes_in = 0
+
+        try:
+            for chunk in chunks:
+                bytes_in += len(chunk)
+
+                yield chunk
+        finally:
+            self.metrics.add_bytes_in("idoklad", "GET", path, bytes_in)
+
+    def get_attachment(self, type, id, filename="GetAttachment"):
         if type == "invoice":
-            return self.get_invoice_attachment(id)
+            return self.get_cached(type, id, filename, self.get_invoice_attachment)
         elif type == "expense":
-            return self.get_expense_attachment(id)
+            return self.get_cached(type, id, filename, self.get_expense_attachment)
 
         return None
 
@@ -118,7 +290,7 @@ class IDokladAPI(object):
         response = self._api_get("/" + path)
 
         if response.status_code == 200:
-            return response.json()
+            return json_codec.response_json(response)
         else:
             raise Exception(
                 ERROR_MESSAGES["request_failed"].format(
@@ -131,7 +303,7 @@ class IDokladAPI(object):
         response = self._api_get("/" + path)
 
         if response.status_code == 200:
-            return response.json()
+            return json_codec.response_json(response)
         else:
             raise Exception(
                 ERROR_MESSAGES["request_failed"].format(
@@ -139,5 +311,56 @@ class IDokladAPI(object):
                 ),
             )
 
-    def _api_get(self, path):
-        return self.session.get(self.api_url + path)
+    def get_cached(self, type, id, filename, load):
+        if not self.attachment_cache:
+            return load(id)
+
+        content = self.attachment_cache.read(type, id, filename)
+
+        if content is not None:
+            return json_codec.loads(content)
+
+        result = load(id)
+
+        if result:
+            self.attachment_cache.write(type, id, filename, json_codec.dumps(result))
+
+        return result
+
+    def _api_get(self, path, stream=False):
+        access_token = self.oauth_client.get_valid_access_token()
+        response = self._send_get(path, access_token, stream)
+
+        if response.status_code == 401:
+            # Revoked or expired earlier than announced, retry once with a new token
+            response.close()
+
+            access_token = self.oauth_client.refresh_access_token(access_token)
+            response = self._send_get(path, access_token, stream)
+
+        return response
+
+    def _send_get(self, path, access_token, stream=False):
+        return self.scheduler.request(
+            self.session,
+            "GET",
+            self.api_url + path,
+            self.metrics,
+            ("idoklad", path),
+            stream=stream,
+            headers={
+                "Authorization": "Bearer {access_token}".format(
+                    access_token=access_token
+                ),
+            },
+        )
+
+
+def adapt_page_size(records, bytes, seconds):
+    # Aim for pages of about IDOKLAD_PAGE_TARGET_BYTES that load within IDOKLAD_PAGE_TARGET_SECONDS
+    page_size = IDOKLAD_PAGE_TARGET_BYTES * records // max(bytes, 1)
+
+    if seconds > 0:
+        page_size = min(page_size, int(IDOKLAD_PAGE_TARGET_SECONDS * records / seconds))
+
+    return max(IDOKLAD_PAGE_SIZE_MIN, min(IDOKLAD_PAGE_SIZE_MAX, page_size))
@@ -1,16 +1,28 @@
 import json
+import os
+import threading
+import time
 from rauth import OAuth2Service
+from rauth.service import process_token_request
+
+from constants import IDOKLAD_TOKEN_URL, IDOKLAD_TOKEN_FILE, IDOKLAD_TOKEN_REFRESH_MARGIN
 
 class IDokladOAuth2Client:
-    def __init__(self, client_id, client_secret):
+    def __init__(self, client_id, client_secret, token_url=IDOKLAD_TOKEN_URL, token_file=IDOKLAD_TOKEN_FILE):
         self.access_token = None
+        self.expires_at = 0
+        self.client_id = client_id
+        self.token_url = token_url
+        self.token_file = token_file
+        self.lock = threading.Lock()
         self.service = OAuth2Service(
             client_id=client_id,
             client_secret=client_secret,
-            access_token_url="https://identity.idoklad.cz/server/connect/token",
+            access_token_url=token_url,
         )
 
-        self.get_access_token()
+        if not self.load_access_token():
+            self.get_access_token()
 
     def get_access_token(self):
         data = {
@@ -18,6 +30,71 @@ class IDokladOAuth2Client:
             "grant_type": "client_credentials",
         }
 
-        session = self.service.get_auth_session(data=data, decoder=json.loads)
+        response = self.service.get_raw_access_token(data=data)
+        access_token, expires_in = process_token_request(
+            response,
+            json.loads,
+            "access_token",
+            "expires_in",
+        )
+
+        self.access_token = access_token
+        self.expires_at = time.time() + int(expires_in)
+
+        self.save_access_token()
+
+    def get_valid_access_token(self):
+        with self.lock:
+            # Refresh ahead of the expiry, so requests in flight do not fail halfway through a run
+            if time.time() >= self.expires_at - IDOKLAD_TOKEN_REFRESH_MARGIN:
+                print("--- iDoklad - refreshing access token")
+
+                self.get_access_token()
+
+            return self.access_token
+
+    def refresh_access_token(self, rejected_access_token):
+        with self.lock:
+            # Concurrent requests rejected with the same token refresh it only once
+            if self.access_token == rejected_access_token:
+                print("--- iDoklad - access token rejected, requesting a new one")
+
+                self.get_access_token()
+
+            return self.access_token
+
+    def load_access_token(self):
+        try:
+            with open(self.token_file) as file:
+                token = json.load(file)
+        except (FileNotFoundError, ValueError):
+            return False
+
+        if not token.get("client_id") == self.client_id or not token.get("token_url") == self.token_url:
+            return False
+
+        if time.time() >= token["expires_at"] - IDOKLAD_TOKEN_REFRESH_MARGIN:
+            return False
+
+        self.access_token = token["access_token"]
+        self.expires_at = token["expires_at"]
+
+        return True
+
+    def save_access_token(self):
+        if not self.token_file:
+            return
+
+        partial_path = self.token_file + ".part"
+        # The token grants access to the account, keep it readable only by the owner
+        file_descriptor = os.open(partial_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+
+        with os.fdopen(file_descriptor, "w") as file:
+            json.dump({
+                "client_id": self.client_id,
+                "token_url": self.token_url,
+                "access_token": self.access_token,
+                "expires_at": self.expires_at,
+            }, file)
 
-        self.access_token = session.access_token
\ No newline at end of file
+        os.replace(partial_path, self.token_file)
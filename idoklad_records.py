@@ -0,0 +1,172 @@
+from collections import namedtuple
+
+
+IDokladSubject = namedtuple("IDokladSubject", [
+    "company_name",
+    "street",
+    "city",
+    "postal_code",
+    "country_code",
+    "identification_number",
+    "vat_identification_number",
+    "vat_identification_number_sk",
+    "firstname",
+    "surname",
+    "email",
+    "mobile",
+    "www",
+])
+
+IDokladMyCompany = namedtuple("IDokladMyCompany", [
+    "vat_identification_number",
+    "account_number",
+    "bank_number_code",
+    "iban",
+    "swift",
+])
+
+IDokladLine = namedtuple("IDokladLine", [
+    "name",
+    "amount",
+    "unit",
+    "unit_price",
+    "vat_rate",
+    "code",
+    "total_price",
+])
+
+
+class IDokladRecord(object):
+    __slots__ = (
+        "id",
+        "document_number",
+        "date_last_change",
+        "date_of_payment",
+        "attachment_file_name",
+        "variable_symbol",
+        "note",
+        "currency_code",
+        "exchange_rate",
+        "payment_option_code",
+        "my_company",
+        "subject",
+        "lines",
+    )
+
+    def __init__(self, data, my_company, subject, lines):
+        self.id = data["Id"]
+        self.document_number = data["DocumentNumber"]
+        self.date_last_change = data["DateLastChange"]
+        self.date_of_payment = data["DateOfPayment"]
+        self.attachment_file_name = data["AttachmentFileName"]
+        self.variable_symbol = data["VariableSymbol"]
+        self.note = data["Note"]
+        self.currency_code = data["Currency"]["Code"]
+        self.exchange_rate = data["ExchangeRate"]
+        self.payment_option_code = data["PaymentOption"]["Code"]
+        self.my_company = my_company
+        self.subject = subject
+        self.lines = lines
+
+
+class IDokladInvoice(IDokladRecord):
+    __slots__ = (
+        "order_number",
+        "date_of_issue",
+        "date_of_taxing",
+        "maturity",
+        "items_text_prefix",
+        "items_text_suffix",
+        "language_code",
+    )
+
+    def __init__(self, data, my_company, subject, lines):
+        super().__init__(data, my_company, subject, lines)
+
+        self.order_number = data["OrderNumber"]
+        self.date_of_issue = data["DateOfIssue"]
+        self.date_of_taxing = data["DateOfTaxing"]
+        self.maturity = data["Maturity"]
+        self.items_text_prefix = data["ItemsTextPrefix"]
+        self.items_text_suffix = data["ItemsTextSuffix"]
+        self.language_code = data["LanguageCode"]
+
+
+class IDokladExpense(IDokladRecord):
+    __slots__ = (
+        "received_document_number",
+        "date_of_receiving",
+        "description",
+    )
+
+    def __init__(self, data, my_company, subject, lines):
+        super().__init__(data, my_company, subject, lines)
+
+        self.received_document_number = data["ReceivedDocumentNumber"]
+        self.date_of_receiving = data["DateOfReceiving"]
+        self.description = data["Description"]
+
+
+class IDokladRecordParser(object):
+    def __init__(self):
+        # Contacts and the own company repeat across documents, keep one copy of each
+        self.values = {}
+
+    def parse_invoice(self, data):
+        return IDokladInvoice(
+            data,
+            self.parse_my_company(data["MyCompanyDocumentAddress"]),
+            self.parse_subject(data["Purchaser"]),
+            self.parse_lines(data["IssuedInvoiceItems"]),
+        )
+
+    def parse_expense(self, data):
+        return IDokladExpense(
+            data,
+            self.parse_my_company(data["MyCompanyDocumentAddress"]),
+            self.parse_subject(data["Supplier"]),
+            self.parse_lines(data["Items"]),
+        )
+
+    def parse_subject(self, data):
+        return self.share(IDokladSubject(
+            data["CompanyName"],
+            data["Street"],
+            data["City"],
+            data["PostalCode"],
+            data["Country"]["Code"],
+            data["IdentificationNumber"],
+            data["VatIdentificationNumber"],
+            data["VatIdentificationNumberSk"],
+            data["Firstname"],
+            data["Surname"],
+            data["Email"],
+            data["Mobile"],
+            data["Www"],
+        ))
+
+    def parse_my_company(self, data):
+        return self.share(IDokladMyCompany(
+            data["VatIdentificationNumber"],
+            data["AccountNumber"],
+            data["BankNumberCode"],
+            data["Iban"],
+            data["Swift"],
+        ))
+
+    def parse_lines(self, data):
+        return tuple(
+            IDokladLine(
+                item["Name"],
+                item["Amount"],
+                item["Unit"],
+                item["UnitPrice"],
+                item["VatRate"],
+                item.get("Code"),
+                item.get("TotalPrice"),
+            )
+            for item in data
+        )
+
+    def share(self, value):
+        return self.values.setdefault(value, value)
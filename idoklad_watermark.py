@@ -0,0 +1,28 @@
+import threading
+
+
+class IDokladWatermark(object):
+    def __init__(self, cache, filter):
+        # A watermark is only valid for the filter it was collected with
+        self.cache = cache
+        self.key = "watermark:{}".format(filter or "")
+        self.value = cache.get_meta(self.key)
+        self.newest = self.value
+        self.complete = True
+        self.lock = threading.Lock()
+
+    def observe(self, idoklad_record):
+        with self.lock:
+            if not self.newest or idoklad_record.date_last_change > self.newest:
+                self.newest = idoklad_record.date_last_change
+
+    def abort(self):
+        with self.lock:
+            self.complete = False
+
+    def save(self):
+        if self.complete and not self.newest == self.value:
+            self.cache.set_meta(self.key, self.newest)
+            self.value = self.newest
+
+            print("Saved iDoklad watermark {}".format(self.value))
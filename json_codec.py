@@ -0,0 +1,30 @@
+import json
+from urllib3.util import make_headers
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+# gzip and deflate, plus br and zstd when urllib3 can decode them
+ACCEPT_ENCODING = make_headers(accept_encoding=True)["accept-encoding"]
+
+
+def loads(data):
+    # Both backends decode bytes directly, without building a str of the whole body first
+    if orjson:
+        return orjson.loads(data)
+
+    return json.loads(data)
+
+
+def dumps(data):
+    if orjson:
+        return orjson.dumps(data)
+
+    return json.dumps(data, separators=(",", ":")).encode("utf-8")
+
+
+def response_json(response):
+    return loads(response.content)
@@ -4,134 +4,313 @@
 #
 # Check https://api.idoklad.cz/Help/v2/ and https://www.fakturoid.cz/api
 
-import pickle
-
-from constants import CACHE_FILE
-from helpers import parseargs, process_record
+from constants import CACHE_FILE, JOURNAL_FILE, ATTACHMENT_CACHE_DIRECTORY, PROFILE_SLOWEST_RECORDS
+from helpers import parseargs, make_fakturoid_indexes, load_vat_mismatch_policies, VatMismatchPolicy, check_vat_numbers, transfer_records, reconcile_subjects, pay_queued_records, KeyedLocks
 from idoklad_oauth2_client import IDokladOAuth2Client
 from idoklad_api import IDokladAPI
 from fakturoid_api import FakturoidAPI
+from request_scheduler import RequestScheduler
+from cache_store import open_cache_store
+from idoklad_watermark import IDokladWatermark
+from pdf_export import export_pdfs
+from attachment_cache import AttachmentCache
+from request_metrics import RequestMetrics
+from transfer_journal import TransferJournal
+from profiling import Tracer, NULL_TRACER
 
 
-if __name__ == "__main__":
-    args = parseargs()
+def main(argv=None):
+    args = parseargs(argv)
+    scheduler = RequestScheduler(rate=args.rate_limit)
+    metrics = RequestMetrics() if args.metrics_output else None
+    tracer = NULL_TRACER
+
+    if args.profile or args.profile_cprofile:
+        tracer = Tracer(args.profile_cprofile)
+
+    attachment_cache = None
+
+    if args.attachment_cache_size:
+        attachment_cache = AttachmentCache(
+            ATTACHMENT_CACHE_DIRECTORY,
+            args.attachment_cache_size,
+        )
 
     idoklad_oauth_client = IDokladOAuth2Client(
         args.idoklad_client_id,
         args.idoklad_client_secret,
+        args.idoklad_token_url,
+    )
+    idoklad = IDokladAPI(
+        idoklad_oauth_client,
+        args.idoklad_filter,
+        args.idoklad_concurrency,
+        scheduler,
+        attachment_cache,
+        args.idoklad_api_url,
+        metrics,
+        args.idoklad_select_fields,
+        args.idoklad_adaptive_page_size,
     )
-    idoklad = IDokladAPI(idoklad_oauth_client, args.idoklad_filter)
-    idoklad_invoices = idoklad.get_invoices()
-    idoklad_expenses = idoklad.get_expenses()
 
-    print("\n")
+    print("--- Loading API cache")
 
-    try:
-        print("--- Loading Fakturoid API cache")
-        cache = pickle.load(open(CACHE_FILE, "rb"))
-    except IOError:
-        cache = {
-            "subjects": {},
-            "bank_accounts": {},
-        }
-    except Exception as e:
-        print("WARNING: Cache load failed: {}. Continuing anyway.".format(e))
-        cache = {
-            "subjects": {},
-            "bank_accounts": {},
-        }
-
-    cache_keys = [
-        "account",
-        "invoices",
-        "expenses",
-        "subjects",
-        "bank_accounts",
-    ]
-
-    for key in cache_keys:
-        if not key in cache:
-            cache[key] = {}
+    cache = open_cache_store(CACHE_FILE, args.compress_cache)
 
     print("\n")
 
+    invoices_watermark = None
+    expenses_watermark = None
+    invoices_changed_since = None
+    expenses_changed_since = None
+
+    if args.idoklad_incremental:
+        invoices_watermark = IDokladWatermark(
+            cache.collection("idoklad_invoices"),
+            args.idoklad_filter,
+        )
+        expenses_watermark = IDokladWatermark(
+            cache.collection("idoklad_expenses"),
+            args.idoklad_filter,
+        )
+        invoices_changed_since = invoices_watermark.value
+        expenses_changed_since = expenses_watermark.value
+
+    if args.stream:
+        idoklad_invoices = idoklad.iter_invoices(invoices_changed_since)
+        idoklad_expenses = idoklad.iter_expenses(expenses_changed_since)
+    else:
+        with tracer.phase("idoklad_load"):
+            idoklad_invoices = idoklad.get_invoices(invoices_changed_since)
+            idoklad_expenses = idoklad.get_expenses(expenses_changed_since)
+
+        print("\n")
+
+    def list_records(type):
+        # Streamed records can be consumed only once, every phase before the transfer lists them again
+        if type == "invoice":
+            return idoklad.iter_invoices(invoices_changed_since) if args.stream else idoklad_invoices
+
+        return idoklad.iter_expenses(expenses_changed_since) if args.stream else idoklad_expenses
+
+    stats = {
+        "exported_invoices": 0,
+        "exported_expenses": 0,
+        "created_invoices": 0,
+        "created_expenses": 0,
+        "skipped_invoices": 0,
+        "skipped_expenses": 0,
+        "created_subjects": 0,
+        "paid_queued": 0,
+        "failed_payments": 0,
+    }
+
+    if args.export_idoklad_as_pdf or args.export_only:
+        with tracer.phase("export"):
+            stats["exported_invoices"] = export_pdfs(
+                idoklad,
+                list_records("invoice"),
+                "invoice",
+                args.export_concurrency,
+                tracer,
+            )
+            stats["exported_expenses"] = export_pdfs(
+                idoklad,
+                list_records("expense"),
+                "expense",
+                args.export_concurrency,
+                tracer,
+            )
+
+        print("\n")
+
+    if args.export_only:
+        cache.close()
+
+        if attachment_cache:
+            attachment_cache.close()
+        scheduler.print_report()
+
+        if metrics:
+            metrics.save(args.metrics_output, args.metrics_format)
+
+        if args.profile:
+            tracer.save(args.profile)
+
+        return dict(stats, **scheduler.get_totals())
+
     fakturoid = FakturoidAPI(
         args.fakturoid_account_name,
         args.fakturoid_email,
         args.fakturoid_api_key,
-    )
-    fakturoid_account = fakturoid.get_account(cache["account"])
-    fakturoid_invoices = fakturoid.get_invoices(cache["invoices"])
-    fakturoid_expenses = fakturoid.get_expenses(cache["expenses"])
-    fakturoid_subjects = fakturoid.get_subjects(cache["subjects"])
-    fakturoid_bank_accounts = fakturoid.get_bank_accounts(
-        cache["bank_accounts"],
+        args.fakturoid_concurrency,
+        scheduler,
+        args.fakturoid_api_url,
+        metrics,
     )
 
-    pickle.dump(cache, open(CACHE_FILE, "wb"))
+    with tracer.phase("fakturoid_load"):
+        fakturoid_account = fakturoid.get_account(cache.collection("account"))
+        fakturoid_invoices = fakturoid.get_invoices(
+            cache.collection("invoices"),
+            args.fakturoid_delta,
+        )
+        fakturoid_expenses = fakturoid.get_expenses(
+            cache.collection("expenses"),
+            args.fakturoid_delta,
+        )
+        fakturoid_subjects = fakturoid.get_subjects(cache.collection("subjects"))
+        fakturoid_bank_accounts = fakturoid.get_bank_accounts(
+            cache.collection("bank_accounts"),
+        )
+
+        fakturoid_indexes = make_fakturoid_indexes(
+            fakturoid_invoices,
+            fakturoid_expenses,
+            fakturoid_subjects,
+            fakturoid_bank_accounts,
+        )
 
     print("\n")
 
-    created_invoices = 0
-    created_expenses = 0
+    subject_locks = KeyedLocks()
+    journal = TransferJournal(
+        JOURNAL_FILE,
+        {
+            "idoklad_api_url": args.idoklad_api_url,
+            "idoklad_client_id": args.idoklad_client_id,
+            "fakturoid_api_url": args.fakturoid_api_url,
+            "fakturoid_account": args.fakturoid_account_name,
+        },
+    )
+    vat_policy = None
 
-    for idoklad_invoice in idoklad_invoices:
-        result = process_record(
-            idoklad,
-            idoklad_invoice,
-            fakturoid,
-            fakturoid_account,
-            fakturoid_subjects,
-            fakturoid_bank_accounts,
-            fakturoid_invoices,
-            "invoice",
-            args.disable_vat_number_check,
-            args.export_idoklad_as_pdf,
+    if not args.disable_vat_number_check:
+        vat_mismatch_policies = None
+
+        if args.vat_mismatch_policy_file:
+            vat_mismatch_policies = load_vat_mismatch_policies(args.vat_mismatch_policy_file)
+
+        vat_policy = VatMismatchPolicy(
+            fakturoid_account["vat_no"],
+            args.vat_mismatch_policy,
+            vat_mismatch_policies,
         )
 
-        if result == 'continue':
-            continue
+    if vat_policy and vat_policy.requires_check():
+        with tracer.phase("vat_check"):
+            check_vat_numbers(
+                [
+                    ("invoice", list_records("invoice")),
+                    ("expense", list_records("expense")),
+                ],
+                fakturoid_indexes,
+                vat_policy,
+                journal,
+            )
 
-        if result == 'break':
-            break
+        print("\n")
 
-        created_invoices += 1
+    if args.reconcile_subjects:
+        with tracer.phase("reconcile_subjects"):
+            stats["created_subjects"] = reconcile_subjects(
+                fakturoid,
+                [
+                    ("invoice", list_records("invoice")),
+                    ("expense", list_records("expense")),
+                ],
+                fakturoid_indexes,
+                journal,
+                args.subject_concurrency,
+                vat_policy,
+            )
 
-        if "fakturoid_subject" in result:
-            fakturoid_subjects.append(result["fakturoid_subject"])
+        print("\n")
 
-        fakturoid_invoices.append(result["fakturoid_record"])
+    with tracer.phase("transfer_invoices"):
+        invoices = transfer_records(
+            idoklad,
+            idoklad_invoices,
+            fakturoid,
+            fakturoid_account,
+            fakturoid_indexes,
+            "invoice",
+            vat_policy,
+            args.workers,
+            subject_locks,
+            journal,
+            invoices_watermark,
+            args.prefetch_attachments,
+            args.prefetch_memory_budget,
+            tracer,
+            args.defer_payments,
+        )
 
-    for idoklad_expense in idoklad_expenses:
-        result = process_record(
+    with tracer.phase("transfer_expenses"):
+        expenses = transfer_records(
             idoklad,
-            idoklad_expense,
+            idoklad_expenses,
             fakturoid,
             fakturoid_account,
-            fakturoid_subjects,
-            fakturoid_bank_accounts,
-            fakturoid_expenses,
+            fakturoid_indexes,
             "expense",
-            args.disable_vat_number_check,
-            args.export_idoklad_as_pdf,
+            vat_policy,
+            args.workers,
+            subject_locks,
+            journal,
+            expenses_watermark,
+            args.prefetch_attachments,
+            args.prefetch_memory_budget,
+            tracer,
+            args.defer_payments,
         )
 
-        if result == 'continue':
-            continue
-
-        if result == 'break':
-            break
-
-        created_expenses += 1
+    # Also pays what earlier runs queued and did not manage to pay
+    with tracer.phase("pay_queued"):
+        payments = pay_queued_records(fakturoid, journal, args.payment_concurrency, tracer)
 
-        if "fakturoid_subject" in result:
-            fakturoid_subjects.append(result["fakturoid_subject"])
-
-        fakturoid_expenses.append(result["fakturoid_record"])
+    if args.idoklad_incremental:
+        invoices_watermark.save()
+        expenses_watermark.save()
 
     print(
         "\nCreated {invoices} invoices and {expenses} expenses".format(
-            invoices=created_invoices,
-            expenses=created_expenses,
+            invoices=invoices["created"],
+            expenses=expenses["created"],
         )
     )
+
+    if invoices["skipped"] or expenses["skipped"]:
+        print(
+            "Skipped {invoices} invoices and {expenses} expenses with a different VAT number".format(
+                invoices=invoices["skipped"],
+                expenses=expenses["skipped"],
+            )
+        )
+
+    journal.close()
+    cache.close()
+
+    if attachment_cache:
+        attachment_cache.close()
+    scheduler.print_report()
+
+    if metrics:
+        metrics.save(args.metrics_output, args.metrics_format)
+
+    if args.profile:
+        tracer.save(args.profile)
+        tracer.print_slowest(PROFILE_SLOWEST_RECORDS)
+
+    stats["created_invoices"] = invoices["created"]
+    stats["created_expenses"] = expenses["created"]
+    stats["skipped_invoices"] = invoices["skipped"]
+    stats["skipped_expenses"] = expenses["skipped"]
+    stats["paid_queued"] = payments["paid"]
+    stats["failed_payments"] = payments["failed"]
+
+    return dict(stats, **scheduler.get_totals())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+import base64
+import hashlib
+import os
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from constants import (
+    EXPORT_DIRECTORY,
+    EXPORT_INVOICE_DIRECTORY,
+    EXPORT_EXPENSE_DIRECTORY,
+    EXPORT_CHUNK_SIZE,
+)
+from profiling import NULL_TRACER
+
+
+def export_file_path(type, filename):
+    return "{root_dir}/{type_dir}/{filename}.pdf".format(
+        root_dir=EXPORT_DIRECTORY,
+        type_dir=EXPORT_INVOICE_DIRECTORY if type == 'invoice' else EXPORT_EXPENSE_DIRECTORY,
+        filename=filename,
+    )
+
+
+def file_sha256(file_path):
+    sha256 = hashlib.sha256()
+
+    with open(file_path, "rb") as file:
+        for chunk in iter(lambda: file.read(EXPORT_CHUNK_SIZE), b""):
+            sha256.update(chunk)
+
+    return sha256.hexdigest()
+
+
+def pdf_already_exported(file_path):
+    checksum_path = file_path + ".sha256"
+
+    if not os.path.exists(file_path) or not os.path.exists(checksum_path):
+        return False
+
+    with open(checksum_path, "r") as file:
+        checksum = file.read().strip()
+
+    return checksum == file_sha256(file_path)
+
+
+def decode_base64_json_stream(chunks):
+    # The body is a JSON string, drop the quotes, the escaping of "/" and whitespace
+    remainder = b""
+
+    for chunk in chunks:
+        data = remainder + chunk.translate(None, b"\"\\ \r\n\t")
+        usable = len(data) - len(data) % 4
+
+        if usable:
+            yield base64.b64decode(data[:usable])
+
+        remainder = data[usable:]
+
+    if remainder:
+        yield base64.b64decode(remainder)
+
+
+def export_pdf(idoklad, type, idoklad_record, tracer=NULL_TRACER):
+    with tracer.span("pdf_export", "stage", type=type, number=idoklad_record.document_number) as span:
+        span["bytes"] = write_pdf(idoklad, type, idoklad_record)
+
+    return span["bytes"] is not None
+
+
+def write_pdf(idoklad, type, idoklad_record):
+    file_path = export_file_path(type, idoklad_record.document_number)
+
+    if pdf_already_exported(file_path):
+        return None
+
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+
+    partial_path = file_path + ".part"
+    sha256 = hashlib.sha256()
+    size = 0
+    chunks = idoklad.iter_pdf(type, idoklad_record.id, EXPORT_CHUNK_SIZE)
+
+    with open(partial_path, "wb") as file:
+        for chunk in decode_base64_json_stream(chunks):
+            sha256.update(chunk)
+            size += len(chunk)
+            file.write(chunk)
+
+    os.replace(partial_path, file_path)
+
+    with open(file_path + ".sha256", "w") as file:
+        file.write(sha256.hexdigest())
+
+    return size
+
+
+def export_pdfs(idoklad, idoklad_records, type, concurrency=1, tracer=NULL_TRACER):
+    state = {"exported": 0, "skipped": 0}
+
+    print("--- Exporting iDoklad {}s as PDF".format(type))
+
+    def collect(future, idoklad_record):
+        if future.result():
+            state["exported"] += 1
+
+            print("Exported {} {}".format(type, idoklad_record.document_number))
+        else:
+            state["skipped"] += 1
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        pending = {}
+
+        for idoklad_record in idoklad_records:
+            if len(pending) >= concurrency * 2:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+
+                for future in done:
+                    collect(future, pending.pop(future))
+
+            pending[executor.submit(export_pdf, idoklad, type, idoklad_record, tracer)] = idoklad_record
+
+        done, _ = wait(pending)
+
+        for future in done:
+            collect(future, pending[future])
+
+    print(
+        "Exported {exported} {type}s, {skipped} already exported".format(
+            type=type,
+            **state
+        )
+    )
+
+    return state["exported"]
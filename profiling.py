@@ -0,0 +1,105 @@
+import cProfile
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+
+
+class Tracer(object):
+    def __init__(self, cprofile_directory=None):
+        self.cprofile_directory = cprofile_directory
+        self.events = []
+        self.lock = threading.Lock()
+        self.started_at = time.perf_counter()
+
+    @contextmanager
+    def span(self, name, category="record", **args):
+        started_at = time.perf_counter()
+
+        try:
+            yield args
+        finally:
+            finished_at = time.perf_counter()
+
+            with self.lock:
+                self.events.append({
+                    "name": name,
+                    "cat": category,
+                    "ph": "X",
+                    "ts": (started_at - self.started_at) * 1000000,
+                    "dur": (finished_at - started_at) * 1000000,
+                    "pid": os.getpid(),
+                    "tid": threading.get_ident(),
+                    "args": args,
+                })
+
+    @contextmanager
+    def phase(self, name):
+        # cProfile only sees the thread the phase runs in, not the worker pools
+        profile = None
+
+        if self.cprofile_directory:
+            profile = cProfile.Profile()
+            profile.enable()
+
+        try:
+            with self.span(name, "phase"):
+                yield
+        finally:
+            if profile:
+                profile.disable()
+
+                os.makedirs(self.cprofile_directory, exist_ok=True)
+                profile.dump_stats(os.path.join(self.cprofile_directory, name + ".prof"))
+
+    def save(self, path):
+        with self.lock:
+            with open(path, "w") as file:
+                json.dump({"traceEvents": self.events, "displayTimeUnit": "ms"}, file)
+
+        print("Saved trace to {}, open it in https://ui.perfetto.dev or chrome://tracing".format(path))
+
+    def print_slowest(self, count):
+        with self.lock:
+            records = [event for event in self.events if event["cat"] == "record"]
+            stages = {}
+
+            for event in self.events:
+                if event["cat"] == "stage":
+                    key = (event["args"]["type"], event["args"]["number"])
+                    stages.setdefault(key, []).append(event)
+
+        if not records:
+            return
+
+        print("\n--- Slowest records")
+
+        for event in sorted(records, key=lambda event: event["dur"], reverse=True)[:count]:
+            key = (event["args"]["type"], event["args"]["number"])
+
+            print("{name}: {seconds:.3f} s, {lines} lines, attachment {attachment!r}, {stages}".format(
+                name=event["name"],
+                seconds=event["dur"] / 1000000,
+                lines=event["args"]["lines"],
+                attachment=event["args"]["attachment"],
+                stages=", ".join(
+                    "{} {:.3f} s{}".format(
+                        stage["name"],
+                        stage["dur"] / 1000000,
+                        " ({} bytes)".format(stage["args"]["bytes"]) if stage["args"].get("bytes") else "",
+                    )
+                    for stage in stages.get(key, [])
+                ),
+            ))
+
+
+class NullTracer(object):
+    def span(self, name, category="record", **args):
+        return nullcontext(args)
+
+    def phase(self, name):
+        return nullcontext()
+
+
+NULL_TRACER = NullTracer()
@@ -0,0 +1,163 @@
+import json
+import re
+import threading
+from urllib.parse import urlparse
+
+from constants import METRICS_LATENCY_BUCKETS
+
+
+class RequestMetrics(object):
+    def __init__(self, buckets=METRICS_LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.endpoints = {}
+        self.lock = threading.Lock()
+
+    def record(self, api, method, path, response, seconds, throttled=0, stream=False):
+        # One attempt, its seconds do not include the throttled time before it
+        bytes_out = len(response.request.body or b"") if response.request else 0
+
+        # Streamed bodies are not read yet, add_bytes_in counts them decoded like the others
+        bytes_in = 0 if stream else len(response.content or b"")
+
+        with self.lock:
+            endpoint = self.get_endpoint(api, method, path)
+            status_code = str(response.status_code)
+
+            endpoint["count"] += 1
+            endpoint["status_codes"][status_code] = endpoint["status_codes"].get(status_code, 0) + 1
+            endpoint["seconds"] += seconds
+            endpoint["throttled_seconds"] += throttled
+            endpoint["bytes_in"] += bytes_in
+            endpoint["bytes_out"] += bytes_out
+
+            if response.status_code == 304:
+                endpoint["cache_hits"] += 1
+
+            for index, bucket in enumerate(self.buckets):
+                if seconds <= bucket:
+                    endpoint["buckets"][index] += 1
+
+    def add_bytes_in(self, api, method, path, bytes_in):
+        with self.lock:
+            self.get_endpoint(api, method, path)["bytes_in"] += bytes_in
+
+    def get_endpoint(self, api, method, path):
+        key = (api, method, endpoint_template(path))
+
+        if not key in self.endpoints:
+            self.endpoints[key] = {
+                "count": 0,
+                "status_codes": {},
+                "seconds": 0,
+                "throttled_seconds": 0,
+                "buckets": [0] * len(self.buckets),
+                "bytes_in": 0,
+                "bytes_out": 0,
+                "cache_hits": 0,
+            }
+
+        return self.endpoints[key]
+
+    def to_json(self):
+        endpoints = []
+        requests = 0
+        cache_hits = 0
+
+        with self.lock:
+            for (api, method, path), endpoint in sorted(self.endpoints.items()):
+                requests += endpoint["count"]
+                cache_hits += endpoint["cache_hits"]
+
+                endpoints.append({
+                    "api": api,
+                    "method": method,
+                    "endpoint": path,
+                    "count": endpoint["count"],
+                    "status_codes": endpoint["status_codes"],
+                    "seconds": round(endpoint["seconds"], 6),
+                    "throttled_seconds": round(endpoint["throttled_seconds"], 6),
+                    "latency_buckets": dict(
+                        zip([str(bucket) for bucket in self.buckets], endpoint["buckets"])
+                    ),
+                    "bytes_in": endpoint["bytes_in"],
+                    "bytes_out": endpoint["bytes_out"],
+                    "cache_hits": endpoint["cache_hits"],
+                    "cache_hit_ratio": round(endpoint["cache_hits"] / endpoint["count"], 4),
+                })
+
+        return json.dumps({
+            "requests": requests,
+            "cache_hits": cache_hits,
+            "cache_hit_ratio": round(cache_hits / requests, 4) if requests else 0,
+            "endpoints": endpoints,
+        }, indent=2)
+
+    def to_prometheus(self):
+        lines = [
+            "# HELP transfer_api_request_duration_seconds Duration of each API request attempt, without the time throttled before it.",
+            "# TYPE transfer_api_request_duration_seconds histogram",
+        ]
+        counters = {
+            "transfer_api_requests_total": [],
+            "transfer_api_throttled_seconds_total": [],
+            "transfer_api_response_bytes_total": [],
+            "transfer_api_request_bytes_total": [],
+            "transfer_api_cache_hits_total": [],
+        }
+
+        with self.lock:
+            for (api, method, path), endpoint in sorted(self.endpoints.items()):
+                labels = 'api="{}",method="{}",endpoint="{}"'.format(api, method, path)
+
+                for bucket, count in zip(self.buckets, endpoint["buckets"]):
+                    lines.append(
+                        'transfer_api_request_duration_seconds_bucket{{{},le="{}"}} {}'.format(
+                            labels, bucket, count
+                        )
+                    )
+
+                lines.append(
+                    'transfer_api_request_duration_seconds_bucket{{{},le="+Inf"}} {}'.format(
+                        labels, endpoint["count"]
+                    )
+                )
+                lines.append("transfer_api_request_duration_seconds_sum{{{}}} {}".format(
+                    labels, endpoint["seconds"]
+                ))
+                lines.append("transfer_api_request_duration_seconds_count{{{}}} {}".format(
+                    labels, endpoint["count"]
+                ))
+
+                for status_code, count in sorted(endpoint["status_codes"].items()):
+                    counters["transfer_api_requests_total"].append(
+                        '{{{},status="{}"}} {}'.format(labels, status_code, count)
+                    )
+
+                counters["transfer_api_throttled_seconds_total"].append(
+                    "{{{}}} {}".format(labels, endpoint["throttled_seconds"])
+                )
+                counters["transfer_api_response_bytes_total"].append(
+                    "{{{}}} {}".format(labels, endpoint["bytes_in"])
+                )
+                counters["transfer_api_request_bytes_total"].append(
+                    "{{{}}} {}".format(labels, endpoint["bytes_out"])
+                )
+                counters["transfer_api_cache_hits_total"].append(
+                    "{{{}}} {}".format(labels, endpoint["cache_hits"])
+                )
+
+        for name in counters:
+            lines.append("# TYPE {} counter".format(name))
+            lines += [name + sample for sample in counters[name]]
+
+        return "\n".join(lines) + "\n"
+
+    def save(self, path, format):
+        with open(path, "w") as file:
+            file.write(self.to_prometheus() if format == "prometheus" else self.to_json())
+
+        print("Saved request metrics to {}".format(path))
+
+
+def endpoint_template(path):
+    return re.sub(r"/\d+(?=/|$)", "/{id}", urlparse(path).path)
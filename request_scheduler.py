@@ -0,0 +1,285 @@
+import random
+import re
+import threading
+import time
+from collections import deque
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlparse
+
+from constants import (
+    RATE_LIMIT_PER_SECOND,
+    RATE_LIMIT_MIN_PER_SECOND,
+    RATE_LIMIT_INCREASE,
+    RATE_LIMIT_BURST,
+    RATE_LIMIT_MAX_RETRIES,
+    RATE_LIMIT_BACKOFF_BASE,
+    RATE_LIMIT_BACKOFF_MAX,
+)
+
+
+class TokenBucket(object):
+    # Without a rate the bucket lets every request through. Until the host sends its rate limit
+    # headers, each 429 halves the rate once per wait and every second without a 429 raises it
+    # by RATE_LIMIT_INCREASE again
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.adaptive = True
+        self.increased_at = time.monotonic()
+        self.sent = deque()
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self.blocked_until = 0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        waited = 0
+
+        while True:
+            with self.lock:
+                now = time.monotonic()
+
+                if self.rate:
+                    self.tokens = min(
+                        self.capacity,
+                        self.tokens + (now - self.updated_at) * self.rate,
+                    )
+
+                self.updated_at = now
+
+                if now < self.blocked_until:
+                    delay = self.blocked_until - now
+                elif not self.rate:
+                    self.track(now)
+
+                    return waited
+                elif self.tokens >= 1:
+                    self.tokens -= 1
+                    self.track(now)
+
+                    return waited
+                else:
+                    delay = (1 - self.tokens) / self.rate
+
+            time.sleep(delay)
+            waited += delay
+
+    def track(self, now):
+        # Requests sent in the last second, the rate a 429 without a known limit is halved from
+        self.sent.append(now)
+
+        while self.sent[0] < now - 1:
+            self.sent.popleft()
+
+    def block(self, seconds):
+        with self.lock:
+            # 429s of requests sent before the last one are answered by the same wait
+            if self.adaptive and time.monotonic() >= self.blocked_until:
+                self.rate = max(RATE_LIMIT_MIN_PER_SECOND, (self.rate or len(self.sent)) / 2)
+                self.increased_at = time.monotonic()
+
+            self.tokens = 0
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+    def succeeded(self):
+        with self.lock:
+            now = time.monotonic()
+
+            if self.adaptive and self.rate and now > self.blocked_until:
+                self.rate += RATE_LIMIT_INCREASE * (now - max(self.increased_at, self.blocked_until))
+
+            self.increased_at = now
+
+    def update(self, limit, window, remaining, reset):
+        with self.lock:
+            if limit and window:
+                self.rate = limit / window
+                self.adaptive = False
+
+            if remaining is not None:
+                self.tokens = min(self.tokens, remaining)
+
+                if remaining <= 0 and reset:
+                    self.blocked_until = max(self.blocked_until, time.monotonic() + reset)
+
+
+class RequestScheduler(object):
+    def __init__(
+        self,
+        rate=RATE_LIMIT_PER_SECOND,
+        burst=RATE_LIMIT_BURST,
+        max_retries=RATE_LIMIT_MAX_RETRIES,
+    ):
+        self.rate = rate
+        self.burst = burst
+        self.max_retries = max_retries
+        self.buckets = {}
+        self.stats = {}
+        self.lock = threading.Lock()
+
+    def request(self, session, method, url, metrics=None, metrics_key=None, **kwargs):
+        # metrics_key is the (api, path) every attempt is recorded under
+        host = urlparse(url).hostname
+        bucket = self.get_bucket(host)
+        attempt = 0
+        backoff = 0
+
+        while True:
+            throttled = backoff + bucket.acquire()
+
+            self.add_stats(host, throttled=throttled - backoff, requests=1)
+
+            started_at = time.monotonic()
+            response = session.request(method, url, **kwargs)
+
+            if metrics:
+                metrics.record(
+                    metrics_key[0],
+                    method,
+                    metrics_key[1],
+                    response,
+                    time.monotonic() - started_at,
+                    throttled,
+                    kwargs.get("stream", False),
+                )
+
+            bucket.update(*parse_rate_limit_headers(response.headers))
+
+            if not response.status_code == 429:
+                bucket.succeeded()
+
+            if not should_retry(method, response) or attempt >= self.max_retries:
+                return response
+
+            delay = retry_delay(response, attempt)
+
+            print(
+                "{method} {url} returned {status_code}, retrying in {delay:.1f} s".format(
+                    method=method,
+                    url=url,
+                    status_code=response.status_code,
+                    delay=delay,
+                )
+            )
+
+            # A streamed response holds its pooled connection until it is closed
+            response.close()
+
+            backoff = 0
+
+            if response.status_code == 429:
+                # Every request to the host has to wait, not only this one
+                bucket.block(delay)
+            else:
+                time.sleep(delay)
+                self.add_stats(host, throttled=delay)
+                backoff = delay
+
+            self.add_stats(host, retries=1)
+            attempt += 1
+
+    def get_bucket(self, host):
+        with self.lock:
+            if not host in self.buckets:
+                self.buckets[host] = TokenBucket(self.rate, self.burst)
+                self.stats[host] = {"requests": 0, "retries": 0, "throttled": 0}
+
+            return self.buckets[host]
+
+    def add_stats(self, host, **values):
+        with self.lock:
+            for key in values:
+                self.stats[host][key] += values[key]
+
+    def get_totals(self):
+        with self.lock:
+            return {
+                key: sum(stats[key] for stats in self.stats.values())
+                for key in ["requests", "retries", "throttled"]
+            }
+
+    def print_report(self):
+        print("\n--- Rate limiting")
+
+        for host in sorted(self.stats):
+            print(
+                "{host}: {requests} requests, {retries} retries, throttled {throttled:.1f} s".format(
+                    host=host,
+                    **self.stats[host]
+                )
+            )
+
+
+def parse_rate_limit_headers(headers):
+    limit = None
+    window = None
+    remaining = None
+    reset = None
+
+    # Structured headers, eg. X-RateLimit-Policy: default;q=400;w=60 and X-RateLimit: default;r=399;t=59
+    if "X-RateLimit-Policy" in headers:
+        policy = dict(re.findall(r"(\w+)=(\d+)", headers["X-RateLimit-Policy"]))
+
+        if "q" in policy and "w" in policy:
+            limit = int(policy["q"])
+            window = int(policy["w"])
+
+    if "X-RateLimit" in headers:
+        state = dict(re.findall(r"(\w+)=(\d+)", headers["X-RateLimit"]))
+
+        if "r" in state:
+            remaining = int(state["r"])
+
+        if "t" in state:
+            reset = int(state["t"])
+
+    if "X-RateLimit-Limit" in headers and headers["X-RateLimit-Limit"].isdigit():
+        limit = int(headers["X-RateLimit-Limit"])
+        window = window or 60
+
+    if "X-RateLimit-Remaining" in headers and headers["X-RateLimit-Remaining"].isdigit():
+        remaining = int(headers["X-RateLimit-Remaining"])
+
+    if "X-RateLimit-Reset" in headers and headers["X-RateLimit-Reset"].isdigit():
+        reset = int(headers["X-RateLimit-Reset"])
+
+        # Some APIs send an epoch timestamp instead of seconds left
+        if reset > time.time():
+            reset = reset - time.time()
+
+    return limit, window, remaining, reset
+
+
+def should_retry(method, response):
+    # A 429 request was not processed, a 5xx one might have been, so only reads are sent again,
+    # unless a 503 says when to come back
+    if response.status_code == 429:
+        return True
+
+    if response.status_code < 500:
+        return False
+
+    if method in ("GET", "HEAD"):
+        return True
+
+    return response.status_code == 503 and "Retry-After" in response.headers
+
+
+def retry_delay(response, attempt):
+    retry_after = response.headers.get("Retry-After")
+
+    if retry_after:
+        try:
+            delay = float(retry_after)
+        except ValueError:
+            try:
+                delay = parsedate_to_datetime(retry_after).timestamp() - time.time()
+            except (TypeError, ValueError):
+                delay = 0
+
+        if delay > 0:
+            return delay + random.uniform(0, 1)
+
+    backoff = min(RATE_LIMIT_BACKOFF_MAX, RATE_LIMIT_BACKOFF_BASE * 2 ** attempt)
+
+    return backoff / 2 + random.uniform(0, backoff / 2)
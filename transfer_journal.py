@@ -0,0 +1,151 @@
+import json
+import sqlite3
+import threading
+
+from constants import JOURNAL_STAGE_SUBJECT, JOURNAL_STAGE_CREATED, JOURNAL_STAGE_PAID, ERROR_MESSAGES
+
+
+class TransferJournal(object):
+    def __init__(self, path, scope=None):
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.row_factory = sqlite3.Row
+
+        with self.connection:
+            self.connection.execute(
+                """
+                CREATE TABLE IF NOT EXISTS records (
+                    type TEXT NOT NULL,
+                    idoklad_id INTEGER NOT NULL,
+                    number TEXT NOT NULL,
+                    stage TEXT NOT NULL,
+                    fakturoid_subject_id INTEGER,
+                    fakturoid_id INTEGER,
+                    updated_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                    PRIMARY KEY (type, idoklad_id)
+                )
+                """
+            )
+            self.connection.execute(
+                """
+                CREATE TABLE IF NOT EXISTS payments (
+                    type TEXT NOT NULL,
+                    idoklad_id INTEGER NOT NULL,
+                    number TEXT NOT NULL,
+                    fakturoid_id INTEGER NOT NULL,
+                    payload TEXT NOT NULL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    last_error TEXT,
+                    queued_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                    PRIMARY KEY (type, idoklad_id)
+                )
+                """
+            )
+            self.connection.execute(
+                """
+                CREATE TABLE IF NOT EXISTS meta (
+                    key TEXT PRIMARY KEY,
+                    value TEXT NOT NULL
+                )
+                """
+            )
+
+        if scope:
+            self.check_scope(scope)
+
+    def check_scope(self, scope):
+        # Record ids are only unique within one iDoklad and Fakturoid account pair,
+        # a journal of another pair would skip records that were never transferred
+        scope = json.dumps(scope, sort_keys=True)
+
+        with self.lock, self.connection:
+            row = self.connection.execute("SELECT value FROM meta WHERE key = 'scope'").fetchone()
+
+            if not row:
+                self.connection.execute("INSERT INTO meta (key, value) VALUES ('scope', ?)", (scope,))
+
+        if row and not row["value"] == scope:
+            self.close()
+
+            raise Exception(ERROR_MESSAGES["journal_scope_mismatch"].format(row["value"], scope))
+
+    def get(self, type, idoklad_id):
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT * FROM records WHERE type = ? AND idoklad_id = ?",
+                (type, idoklad_id),
+            ).fetchone()
+
+        return dict(row) if row else None
+
+    def record_subject(self, type, idoklad_id, number, fakturoid_subject_id):
+        self._save(type, idoklad_id, number, JOURNAL_STAGE_SUBJECT, fakturoid_subject_id, None)
+
+    def record_created(self, type, idoklad_id, number, fakturoid_subject_id, fakturoid_id):
+        self._save(
+            type,
+            idoklad_id,
+            number,
+            JOURNAL_STAGE_CREATED,
+            fakturoid_subject_id,
+            fakturoid_id,
+        )
+
+    def record_paid(self, type, idoklad_id):
+        with self.lock, self.connection:
+            self.connection.execute(
+                "UPDATE records SET stage = ?, updated_at = CURRENT_TIMESTAMP WHERE type = ? AND idoklad_id = ?",
+                (JOURNAL_STAGE_PAID, type, idoklad_id),
+            )
+            self.connection.execute(
+                "DELETE FROM payments WHERE type = ? AND idoklad_id = ?",
+                (type, idoklad_id),
+            )
+
+    def queue_payment(self, type, idoklad_id, number, fakturoid_id, payload):
+        with self.lock, self.connection:
+            # A payment queued by an earlier run keeps its attempts
+            self.connection.execute(
+                """
+                INSERT OR IGNORE INTO payments (type, idoklad_id, number, fakturoid_id, payload)
+                VALUES (?, ?, ?, ?, ?)
+                """,
+                (type, idoklad_id, number, fakturoid_id, json.dumps(payload)),
+            )
+
+    def get_queued_payments(self):
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT * FROM payments ORDER BY queued_at, type, idoklad_id",
+            ).fetchall()
+
+        return [dict(row, payload=json.loads(row["payload"])) for row in rows]
+
+    def payment_failed(self, type, idoklad_id, error):
+        with self.lock, self.connection:
+            self.connection.execute(
+                "UPDATE payments SET attempts = attempts + 1, last_error = ? WHERE type = ? AND idoklad_id = ?",
+                (error, type, idoklad_id),
+            )
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+    def _save(self, type, idoklad_id, number, stage, fakturoid_subject_id, fakturoid_id):
+        with self.lock, self.connection:
+            self.connection.execute(
+                """
+                INSERT OR REPLACE INTO records
+                    (type, idoklad_id, number, stage, fakturoid_subject_id, fakturoid_id, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
+                """,
+                (type, idoklad_id, number, stage, fakturoid_subject_id, fakturoid_id),
+            )
+
+
+def journal_record_finished(entry, idoklad_record):
+    if entry["stage"] == JOURNAL_STAGE_PAID:
+        return True
+
+    return entry["stage"] == JOURNAL_STAGE_CREATED and idoklad_record.date_of_payment == ""